@@ -0,0 +1,208 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+
+import wire
+
+BATCH_SIZE = 64
+
+
+class IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IoVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+class SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort),
+                ('sin_port', ctypes.c_ubyte * 2),
+                ('sin_addr', ctypes.c_ubyte * 4),
+                ('sin_zero', ctypes.c_ubyte * 8)]
+
+
+def load_mmsg_functions():
+    if not sys.platform.startswith('linux'):
+        return None, None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+
+    return recvmmsg, sendmmsg
+
+
+recvmmsg, sendmmsg = load_mmsg_functions()
+
+
+class BufferPool:
+    def __init__(self, buffer_size, max_free_buffers):
+        self.buffer_size = buffer_size
+        self.max_free_buffers = max_free_buffers
+        self.free_buffers = []
+
+    def acquire(self):
+        if len(self.free_buffers) > 0:
+            return self.free_buffers.pop()
+
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        if len(self.free_buffers) < self.max_free_buffers:
+            self.free_buffers.append(buffer)
+
+
+# Drains every datagram waiting on a non-blocking UDP socket into pooled buffers, with one recvmmsg call per
+# batch where the C library provides it and recvfrom_into otherwise. Outgoing datagrams can be queued and sent
+# in one sendmmsg call. Received buffers belong to the caller until they are handed back with release(); a
+# buffer that is never released is simply garbage collected.
+class BatchSocket:
+    def __init__(self, sock, batch_size=BATCH_SIZE, buffer_size=wire.MAX_PACKET_LEN):
+        self.socket = sock
+        self.batch_size = batch_size
+        self.buffer_pool = BufferPool(buffer_size, batch_size * 4)
+        self.use_mmsg = recvmmsg is not None and sock.family == socket.AF_INET
+        self.outgoing = []
+
+        if self.use_mmsg:
+            self.receive_messages = (MMsgHdr * batch_size)()
+            self.receive_iovecs = (IoVec * batch_size)()
+            self.receive_names = (SockAddrIn * batch_size)()
+            self.receive_buffers = [None] * batch_size
+
+            for index in range(batch_size):
+                message = self.receive_messages[index].msg_hdr
+                message.msg_name = ctypes.addressof(self.receive_names[index])
+                message.msg_iov = ctypes.pointer(self.receive_iovecs[index])
+                message.msg_iovlen = 1
+                self.set_receive_buffer(index, self.buffer_pool.acquire())
+
+            self.send_messages = (MMsgHdr * batch_size)()
+            self.send_iovecs = (IoVec * batch_size)()
+            self.send_names = {}
+            for index in range(batch_size):
+                self.send_messages[index].msg_hdr.msg_iov = ctypes.pointer(self.send_iovecs[index])
+                self.send_messages[index].msg_hdr.msg_iovlen = 1
+
+    def set_receive_buffer(self, index, buffer):
+        c_buffer = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+        self.receive_buffers[index] = (buffer, c_buffer)
+        self.receive_iovecs[index].iov_base = ctypes.addressof(c_buffer)
+        self.receive_iovecs[index].iov_len = len(buffer)
+
+    def receive_batch(self):
+        # Returns (buffer, length, address) for each datagram that was waiting
+        if self.use_mmsg:
+            return self.receive_mmsg()
+
+        datagrams = []
+        while len(datagrams) < self.batch_size:
+            buffer = self.buffer_pool.acquire()
+            try:
+                length, address = self.socket.recvfrom_into(buffer)
+            except BlockingIOError:
+                self.buffer_pool.release(buffer)
+                break
+
+            datagrams.append((buffer, length, address))
+
+        return datagrams
+
+    def receive_mmsg(self):
+        for index in range(self.batch_size):
+            self.receive_messages[index].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+
+        count = recvmmsg(self.socket.fileno(), self.receive_messages, self.batch_size, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(error, 'recvmmsg failed')
+
+        datagrams = []
+        for index in range(count):
+            name = self.receive_names[index]
+            address = (socket.inet_ntoa(bytes(name.sin_addr)), int.from_bytes(bytes(name.sin_port), 'big'))
+            datagrams.append((self.receive_buffers[index][0], self.receive_messages[index].msg_len, address))
+            self.set_receive_buffer(index, self.buffer_pool.acquire())
+
+        return datagrams
+
+    def release(self, buffer):
+        self.buffer_pool.release(buffer)
+
+    def queue_send(self, data, address, tag=None):
+        # The data must stay untouched until the next flush()
+        self.outgoing.append((data, address, tag))
+
+    def flush(self):
+        # Sends every queued datagram and returns the tags of those the socket had no room for
+        outgoing = self.outgoing
+        self.outgoing = []
+
+        dropped = []
+        for start in range(0, len(outgoing), self.batch_size):
+            batch = outgoing[start:start + self.batch_size]
+            sent = self.send_mmsg(batch) if self.use_mmsg else 0
+
+            for data, address, tag in batch[sent:]:
+                try:
+                    self.socket.sendto(data, address)
+                except BlockingIOError:
+                    dropped.append(tag)
+
+        return dropped
+
+    def send_mmsg(self, outgoing):
+        c_buffers = []
+        for index, (data, address, tag) in enumerate(outgoing):
+            try:
+                c_buffer = (ctypes.c_char * len(data)).from_buffer(data)
+            except TypeError:
+                # Read-only data such as bytes has to be copied
+                c_buffer = (ctypes.c_char * len(data)).from_buffer_copy(data)
+            c_buffers.append(c_buffer)
+
+            self.send_iovecs[index].iov_base = ctypes.addressof(c_buffer)
+            self.send_iovecs[index].iov_len = len(data)
+
+            message = self.send_messages[index].msg_hdr
+            message.msg_name = ctypes.addressof(self.get_send_name(address))
+            message.msg_namelen = ctypes.sizeof(SockAddrIn)
+
+        sent = sendmmsg(self.socket.fileno(), self.send_messages, len(outgoing), socket.MSG_DONTWAIT)
+        return max(sent, 0)
+
+    def get_send_name(self, address):
+        name = self.send_names.get(address)
+        if name is None:
+            name = SockAddrIn()
+            name.sin_family = socket.AF_INET
+            name.sin_port[:] = address[1].to_bytes(2, 'big')
+            name.sin_addr[:] = socket.inet_aton(address[0])
+            self.send_names[address] = name
+
+        return name
@@ -0,0 +1,245 @@
+import argparse
+import filecmp
+import itertools
+import json
+import math
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Everything runs on the loopback interface under a name that resolves there on any machine
+HOST_NAME = 'localhost'
+EMULATOR_PORT = 6000
+SENDER_PORT = 5000
+REQUESTER_PORT = 4000
+STARTUP_WAIT = 0.5
+
+TRANSMISSIONS_PATTERN = re.compile(r'on (\d+) retransmissions and (\d+) total transmissions')
+DURATION_PATTERN = re.compile(r'Duration of the test:\s+(\d+) ms')
+
+
+# One of the three programs, run from its own directory with its output going to <name>.out. It is reaped
+# with wait4 so the CPU time it used can be reported.
+class Process:
+    def __init__(self, name, script, arguments, directory):
+        self.name = name
+        self.output_filename = os.path.join(directory, name + '.out')
+        self.exit_code = None
+        self.cpu_time = None
+
+        with open(self.output_filename, 'w') as output:
+            self.process = subprocess.Popen([sys.executable, '-u', os.path.join(REPO_DIR, script)]
+                                            + [str(argument) for argument in arguments],
+                                            cwd=directory, stdout=output, stderr=subprocess.STDOUT)
+
+    def wait(self, timeout=None):
+        # Returns False if the process is still running after timeout seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            pid, status, rusage = os.wait4(self.process.pid, 0 if deadline is None else os.WNOHANG)
+            if pid != 0:
+                self.exit_code = os.waitstatus_to_exitcode(status)
+                self.process.returncode = self.exit_code
+                self.cpu_time = rusage.ru_utime + rusage.ru_stime
+                return True
+
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def stop(self):
+        if self.exit_code is not None:
+            return
+
+        self.process.send_signal(signal.SIGTERM)
+        if not self.wait(5):
+            self.process.kill()
+            self.wait()
+
+    def read_output(self):
+        with open(self.output_filename, 'r', errors='replace') as output:
+            return output.read()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(usage="benchmark.py [-s <sizes>] [-w <windows>] [-r <rates>] [-l <lengths>] "
+                                           "[-q <queue_sizes>] [-b <bandwidths>] [-y <delays>] [-x <losses>] "
+                                           "[-m <modes>] [-n <repeats>] [-t <timeout>] [-i <sender_timeout>] "
+                                           "[-o <output>] [-k]")
+
+    parser.add_argument('-s', type=int, nargs='+', default=[100000], help='File sizes in bytes', required=False)
+    parser.add_argument('-w', type=int, nargs='+', default=[10], help='Requester window sizes', required=False)
+    parser.add_argument('-r', type=int, nargs='+', default=[1000], help='Sender packet rates per second',
+                        required=False)
+    parser.add_argument('-l', type=int, nargs='+', default=[1000], help='Payload lengths in bytes', required=False)
+    parser.add_argument('-q', type=int, nargs='+', default=[100],
+                        help='Emulator queue sizes, which only fill up behind a -b bandwidth limit', required=False)
+    parser.add_argument('-b', type=int, nargs='+', default=[0],
+                        help='Emulator link bandwidths in kilobits per second, 0 is unlimited', required=False)
+    parser.add_argument('-y', type=str, nargs='+', default=['0'],
+                        help='Emulator delays, anything the forwarding table accepts', required=False)
+    parser.add_argument('-x', type=str, nargs='+', default=['0'],
+                        help='Emulator losses, anything the forwarding table accepts', required=False)
+    parser.add_argument('-m', choices=['fixed', 'adaptive', 'aimd'], nargs='+', default=['fixed'],
+                        help='Sender modes', required=False)
+    parser.add_argument('-n', type=int, default=3, help='Runs of every combination', required=False)
+    parser.add_argument('-t', type=float, default=60, help='Seconds before a transfer is given up', required=False)
+    parser.add_argument('-i', type=int, default=200, help='Sender retransmission timeout in milliseconds',
+                        required=False)
+    parser.add_argument('-o', type=str, default='benchmark.json', help='Name of the results file', required=False)
+    parser.add_argument('-k', action='store_true', help='Keep the working directories', required=False)
+
+    return parser.parse_args()
+
+
+def get_combinations(args):
+    names = ['size', 'window', 'rate', 'length', 'queue_size', 'bandwidth', 'delay', 'loss', 'mode']
+    for values in itertools.product(args.s, args.w, args.r, args.l, args.q, args.b, args.y, args.x, args.m):
+        yield dict(zip(names, values))
+
+
+def write_run_files(directory, parameters):
+    for name in ('emulator', 'sender', 'requester'):
+        os.makedirs(os.path.join(directory, name))
+
+    with open(os.path.join(directory, 'emulator', 'table'), 'w') as table:
+        for port in (REQUESTER_PORT, SENDER_PORT):
+            table.write(' '.join([HOST_NAME, str(EMULATOR_PORT), HOST_NAME, str(port), HOST_NAME, str(port),
+                                  parameters['delay'], parameters['loss'], str(parameters['bandwidth'])]) + '\n')
+
+    with open(os.path.join(directory, 'requester', 'tracker.txt'), 'w') as tracker:
+        tracker.write(' '.join(['file.bin', '1', HOST_NAME, str(SENDER_PORT), str(parameters['size'])]) + '\n')
+
+    with open(os.path.join(directory, 'sender', 'file.bin'), 'wb') as file:
+        file.write(os.urandom(parameters['size']))
+
+
+def run_transfer(directory, parameters, args):
+    write_run_files(directory, parameters)
+
+    emulator = Process('emulator', 'emulator/emulator.py',
+                       ['-p', EMULATOR_PORT, '-q', parameters['queue_size'], '-f', 'table', '-l', 'log',
+                        '-u', HOST_NAME], os.path.join(directory, 'emulator'))
+    sender = Process('sender', 'sender/sender.py',
+                     ['-p', SENDER_PORT, '-g', REQUESTER_PORT, '-r', parameters['rate'], '-q', 1,
+                      '-l', parameters['length'], '-f', HOST_NAME, '-e', EMULATOR_PORT, '-i', 1, '-t', args.i,
+                      '-m', parameters['mode'], '-u', HOST_NAME, '-x', 'metrics.json'],
+                     os.path.join(directory, 'sender'))
+    time.sleep(STARTUP_WAIT)
+
+    start_time = time.monotonic()
+    requester = Process('requester', 'requester/requester.py',
+                        ['-p', REQUESTER_PORT, '-o', 'file.bin', '-f', HOST_NAME, '-e', EMULATOR_PORT,
+                         '-w', parameters['window'], '-u', HOST_NAME], os.path.join(directory, 'requester'))
+    completed = requester.wait(args.t) and requester.exit_code == 0
+    elapsed = time.monotonic() - start_time
+
+    for process in (requester, sender, emulator):
+        process.stop()
+
+    # The requester's own measurement leaves out interpreter start up
+    durations = [int(duration) for duration in DURATION_PATTERN.findall(requester.read_output())]
+    transfer_time = max(durations) / 1000 if completed and len(durations) > 0 else elapsed
+    transmissions = TRANSMISSIONS_PATTERN.findall(sender.read_output())
+    rtt = read_metrics(os.path.join(directory, 'sender', 'metrics.json')).get('histograms', {}).get('rtt', {})
+
+    return {'completed': completed,
+            'correct': completed and filecmp.cmp(os.path.join(directory, 'sender', 'file.bin'),
+                                                 os.path.join(directory, 'requester', 'file.bin'), shallow=False),
+            'transfer_time': transfer_time,
+            'goodput': parameters['size'] / transfer_time if completed and transfer_time > 0 else None,
+            'retransmissions': int(transmissions[-1][0]) if len(transmissions) > 0 else None,
+            'transmissions': int(transmissions[-1][1]) if len(transmissions) > 0 else None,
+            'rtt_p50': rtt.get('p50'),
+            'rtt_p99': rtt.get('p99'),
+            'cpu_time': {process.name: process.cpu_time for process in (emulator, sender, requester)}}
+
+
+def read_metrics(filename):
+    try:
+        with open(filename, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_percentile(values, percentile):
+    # Nearest rank on sorted values
+    if len(values) == 0:
+        return None
+
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def get_median(values):
+    return get_percentile(sorted(value for value in values if value is not None), 50)
+
+
+def get_mean(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if len(values) > 0 else None
+
+
+def summarize(parameters, samples):
+    completed = [sample for sample in samples if sample['completed']]
+    transfer_times = sorted(sample['transfer_time'] for sample in completed)
+
+    return {'parameters': parameters,
+            'runs': len(samples),
+            'completed': len(completed),
+            'correct': len([sample for sample in samples if sample['correct']]),
+            'goodput': get_median([sample['goodput'] for sample in completed]),
+            'transfer_time_p50': get_percentile(transfer_times, 50),
+            'transfer_time_p99': get_percentile(transfer_times, 99),
+            'retransmissions': get_mean([sample['retransmissions'] for sample in samples]),
+            'transmissions': get_mean([sample['transmissions'] for sample in samples]),
+            # Medians over the runs of the sender's packet round trip percentiles, to its histogram's resolution
+            'rtt_p50': get_median([sample['rtt_p50'] for sample in samples]),
+            'rtt_p99': get_median([sample['rtt_p99'] for sample in samples]),
+            'cpu_time': {name: get_mean([sample['cpu_time'][name] for sample in samples])
+                         for name in ('emulator', 'sender', 'requester')},
+            'samples': samples}
+
+
+def print_summary(summary):
+    goodput = 'failed' if summary['goodput'] is None else str(round(summary['goodput'])) + ' bytes/second'
+    print(' '.join(name + '=' + str(value) for name, value in summary['parameters'].items()))
+    print('    goodput: ' + goodput + ', completed ' + str(summary['completed']) + '/' + str(summary['runs'])
+          + ', correct ' + str(summary['correct']) + '/' + str(summary['runs']))
+
+
+def run_benchmark(args):
+    work_directory = tempfile.mkdtemp(prefix='benchmark-')
+    results = {'started': datetime.now().isoformat(timespec='seconds'),
+               'python': sys.version.split()[0],
+               'results': []}
+
+    try:
+        for combination, parameters in enumerate(get_combinations(args)):
+            samples = [run_transfer(os.path.join(work_directory, str(combination) + '-' + str(run)), parameters, args)
+                       for run in range(args.n)]
+
+            summary = summarize(parameters, samples)
+            print_summary(summary)
+            results['results'].append(summary)
+
+            # Written after every combination so an interrupted sweep still leaves its results
+            with open(args.o, 'w') as output:
+                json.dump(results, output, indent=2)
+    finally:
+        if args.k:
+            print('Working directories kept in ' + work_directory)
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run_benchmark(get_args())
@@ -1,106 +1,512 @@
 import argparse
-import logging
+import heapq
+import json
+import os
+import queue
 import random
+import selectors
+import signal
 import socket
-import struct
+import sys
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import batch_io
+import metrics
+import wire
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PREFIX_MASKS = [(0xFFFFFFFF << (32 - prefix_length)) & 0xFFFFFFFF for prefix_length in range(33)]
+HOST_NAME_TTL = 300
+
+host_name_cache = None
+event_logger = None
+program_metrics = metrics.Metrics()
+
+
+# Random numbers for the link and delay models, generated a block at a time. NumPy fills a block in one call when it is
+# installed and random.Random is used otherwise; either way the same seed gives the same decisions, although the
+# two generators do not agree with each other.
+class RandomSource:
+    BLOCK_SIZE = 4096
+
+    def __init__(self, seed_key=None):
+        if numpy is not None:
+            self.generator = numpy.random.default_rng(seed_key)
+        else:
+            self.generator = random.Random(None if seed_key is None else ':'.join(map(str, seed_key)))
+
+    def get_uniform_block(self):
+        if numpy is not None:
+            return self.generator.random(self.BLOCK_SIZE).tolist()
+
+        uniform = self.generator.random
+        return [uniform() for index in range(self.BLOCK_SIZE)]
+
+    def get_normal_block(self, mean, deviation):
+        if numpy is not None:
+            return self.generator.normal(mean, deviation, self.BLOCK_SIZE).tolist()
+
+        gauss = self.generator.gauss
+        return [gauss(mean, deviation) for index in range(self.BLOCK_SIZE)]
+
+    def get_pareto_block(self, minimum, shape):
+        if numpy is not None:
+            # NumPy's pareto is the Lomax distribution, which starts at 0 rather than 1
+            return ((self.generator.pareto(shape, self.BLOCK_SIZE) + 1) * minimum).tolist()
+
+        paretovariate = self.generator.paretovariate
+        return [minimum * paretovariate(shape) for index in range(self.BLOCK_SIZE)]
+
+    def get_bernoulli_block(self, probability):
+        if numpy is not None:
+            return (self.generator.random(self.BLOCK_SIZE) < probability).tolist()
+
+        uniform = self.generator.random
+        return [uniform() < probability for index in range(self.BLOCK_SIZE)]
+
+
+# Independent events that each happen with the same probability
+class BernoulliEvents:
+    def __init__(self, probability):
+        self.probability = probability
+        self.random_source = None
+        self.decisions = []
+        self.index = 0
+
+    def seed(self, random_source):
+        self.random_source = random_source
+        self.decisions = []
+        self.index = 0
+
+    def next(self):
+        if self.probability <= 0:
+            return False
+
+        if self.index == len(self.decisions):
+            self.decisions = self.random_source.get_bernoulli_block(self.probability)
+            self.index = 0
+
+        decision = self.decisions[self.index]
+        self.index += 1
+        return decision
+
+
+# Gilbert-Elliott burst loss: a good and a bad state with their own loss probabilities, moving from good to
+# bad with probability p and back with probability r after each packet
+class GilbertElliottEvents:
+    def __init__(self, p, r, bad_probability=1.0, good_probability=0.0):
+        self.p = p
+        self.r = r
+        self.bad_probability = bad_probability
+        self.good_probability = good_probability
+        self.bad = False
+        self.random_source = None
+        self.transitions = []
+        self.losses = []
+        self.index = 0
+
+    def seed(self, random_source):
+        self.random_source = random_source
+        self.bad = False
+        self.transitions = []
+        self.losses = []
+        self.index = 0
+
+    def next(self):
+        if self.index == len(self.transitions):
+            self.transitions = self.random_source.get_uniform_block()
+            self.losses = self.random_source.get_uniform_block()
+            self.index = 0
+
+        transition = self.transitions[self.index]
+        loss = self.losses[self.index]
+        self.index += 1
+
+        if self.bad:
+            self.bad = transition >= self.r
+        else:
+            self.bad = transition < self.p
+
+        return loss < (self.bad_probability if self.bad else self.good_probability)
+
+
+def parse_percentages(values):
+    percentages = [float(value) / 100 for value in values]
+    if any(percentage < 0 or percentage > 1 for percentage in percentages):
+        raise ValueError('percentages must be between 0 and 100')
+
+    return percentages
+
+
+def parse_loss_events(spec):
+    # '<percent>' for independent loss or 'ge:<p>/<r>[/<bad loss>[/<good loss>]]' for burst loss, all in percent
+    if spec.startswith('ge:'):
+        parameters = parse_percentages(spec[3:].split('/'))
+        if len(parameters) < 2 or len(parameters) > 4:
+            raise ValueError('Gilbert-Elliott loss takes p/r[/bad loss[/good loss]]')
+        return GilbertElliottEvents(*parameters)
+
+    return BernoulliEvents(*parse_percentages([spec]))
+
+
+# What happens to packets on a link besides their delay. Parsed once from the loss column of the forwarding
+# table: a loss spec optionally followed by comma separated dup=<percent> and reorder=<percent> settings, e.g.
+# '0.5', 'ge:1/25,dup=2' or '5,reorder=10'. A reordered packet skips the link's propagation delay and so
+# overtakes the packets ahead of it.
+class LinkModel:
+    def __init__(self, spec):
+        settings = spec.split(',')
+        self.loss = parse_loss_events(settings[0])
+        self.duplication = BernoulliEvents(0)
+        self.reordering = BernoulliEvents(0)
+
+        for setting in settings[1:]:
+            name, _, value = setting.partition('=')
+            if name == 'dup':
+                self.duplication = BernoulliEvents(*parse_percentages([value]))
+            elif name == 'reorder':
+                self.reordering = BernoulliEvents(*parse_percentages([value]))
+            else:
+                raise ValueError('unknown link setting ' + name)
+
+    def seed(self, seed_key):
+        self.loss.seed(RandomSource(None if seed_key is None else seed_key + (0,)))
+        self.duplication.seed(RandomSource(None if seed_key is None else seed_key + (1,)))
+        self.reordering.seed(RandomSource(None if seed_key is None else seed_key + (2,)))
+
+    def should_drop(self):
+        return self.loss.next()
+
+    def should_duplicate(self):
+        return self.duplication.next()
+
+    def should_reorder(self):
+        return self.reordering.next()
+
+
+# Propagation delay of a link, parsed once from the delay column of the forwarding table. All values are in
+# milliseconds: '<delay>' for a constant delay, 'uniform:<mean>/<jitter>' for delays spread evenly over
+# mean +- jitter, 'normal:<mean>/<jitter>' with jitter as the standard deviation, or 'pareto:<minimum>/<shape>'
+# for heavy tailed delays. Packets leave in the order they were sent unless ',unordered' is appended, in which
+# case a packet drawing a short delay can overtake the ones ahead of it.
+class DelayModel:
+    DISTRIBUTIONS = ('uniform', 'normal', 'pareto')
+
+    def __init__(self, spec):
+        settings = spec.split(',')
+        distribution, _, parameters = settings[0].partition(':')
+        self.preserve_order = True
+        self.last_release_time = 0
+        self.random_source = None
+        self.delays = []
+        self.index = 0
+
+        if parameters == '':
+            self.distribution = 'constant'
+            self.parameters = [float(distribution) / 1000]
+        elif distribution in self.DISTRIBUTIONS:
+            self.distribution = distribution
+            self.parameters = [float(parameter) for parameter in parameters.split('/')]
+            if len(self.parameters) != 2:
+                raise ValueError(distribution + ' delay takes two parameters')
+            if distribution == 'pareto':
+                if self.parameters[1] <= 0:
+                    raise ValueError('pareto shape must be positive')
+                self.parameters[0] /= 1000
+            else:
+                self.parameters = [parameter / 1000 for parameter in self.parameters]
+        else:
+            raise ValueError('unknown delay distribution ' + distribution)
+
+        if self.parameters[0] < 0:
+            raise ValueError('delay must not be negative')
+
+        for setting in settings[1:]:
+            if setting == 'unordered':
+                self.preserve_order = False
+            else:
+                raise ValueError('unknown delay setting ' + setting)
+
+    def seed(self, seed_key):
+        self.random_source = RandomSource(seed_key)
+        self.delays = []
+        self.index = 0
+
+    def get_delay_block(self):
+        first, second = self.parameters
+        if self.distribution == 'uniform':
+            return [first - second + 2 * second * value for value in self.random_source.get_uniform_block()]
+        if self.distribution == 'normal':
+            return self.random_source.get_normal_block(first, second)
+
+        return self.random_source.get_pareto_block(first, second)
+
+    def get_delay(self):
+        if self.distribution == 'constant':
+            return self.parameters[0]
+
+        if self.index == len(self.delays):
+            self.delays = self.get_delay_block()
+            self.index = 0
+
+        delay = self.delays[self.index]
+        self.index += 1
+        return max(delay, 0)
+
+    def get_release_time(self, departure_time):
+        release_time = departure_time + self.get_delay()
+        if self.preserve_order:
+            release_time = max(release_time, self.last_release_time)
+            self.last_release_time = release_time
+
+        return release_time
+
 
 class ForwardingEntry:
     def __init__(self, row_columns):
         self.emulator_host_name = row_columns[0]
         self.emulator_port = int(row_columns[1])
         self.destination_host_name = row_columns[2]
-        self.destination_port = int(row_columns[3])
+        # A '*' port matches any destination port
+        self.destination_port = None if row_columns[3] == '*' else int(row_columns[3])
         self.next_hop_host_name = row_columns[4]
         self.next_hop_port = int(row_columns[5])
-        self.delay = int(row_columns[6])
-        self.loss_probability = row_columns[7]
+        self.next_hop_address = (socket.gethostbyname(self.next_hop_host_name), self.next_hop_port)
+        self.delay_model = DelayModel(row_columns[6])
+        self.link_model = LinkModel(row_columns[7])
+        # Optional link bandwidth in kilobits per second, 0 means unlimited
+        self.bandwidth = int(row_columns[8]) if len(row_columns) > 8 else 0
+
+    def seed(self, seed_key):
+        self.link_model.seed(seed_key)
+        self.delay_model.seed(None if seed_key is None else seed_key + (3,))
+
+    def get_serialization_delay(self, packet):
+        if self.bandwidth <= 0:
+            return 0
+
+        return len(packet.buffer) * 8 / (self.bandwidth * 1000)
+
+    def get_destination_prefix(self):
+        # Destinations are a host name, an ip/prefix_length network or '*' for a default route
+        if self.destination_host_name == '*':
+            return 0, 0
+
+        if '/' in self.destination_host_name:
+            network, prefix_length = self.destination_host_name.split('/')
+            return wire.convert_ip_to_int(network), int(prefix_length)
+
+        return wire.convert_ip_to_int(socket.gethostbyname(self.destination_host_name)), 32
+
+
+class ForwardingTable:
+    def __init__(self):
+        # Routes grouped by prefix length, each keyed by (network, port) with None as the port wildcard
+        self.routes = {}
+        self.prefix_lengths = []
+        self.entries = []
+
+    def add_entry(self, forwarding_entry):
+        self.entries.append(forwarding_entry)
+
+        network, prefix_length = forwarding_entry.get_destination_prefix()
+        routes = self.routes.setdefault(prefix_length, {})
+        routes.setdefault((network & PREFIX_MASKS[prefix_length], forwarding_entry.destination_port), forwarding_entry)
+
+        self.prefix_lengths = sorted(self.routes.keys(), reverse=True)
+
+    def lookup(self, int_dest_ip, dest_port):
+        for prefix_length in self.prefix_lengths:
+            routes = self.routes[prefix_length]
+            network = int_dest_ip & PREFIX_MASKS[prefix_length]
+
+            forwarding_entry = routes.get((network, dest_port))
+            if forwarding_entry is None:
+                forwarding_entry = routes.get((network, None))
+            if forwarding_entry is not None:
+                return forwarding_entry
+
+        return None
+
+    def seed(self, seed, worker=0):
+        # Every entry of every worker draws from its own streams, so one route's traffic never shifts another's
+        for index, forwarding_entry in enumerate(self.entries):
+            forwarding_entry.seed(None if seed is None else (seed, worker, index))
 
 
 class ForwardingQueue:
-    def __init__(self, max_size):
-        self.priority_queue1 = []
-        self.priority_queue2 = []
-        self.priority_queue3 = []
+    # Random early detection thresholds as fractions of the queue size
+    RED_MIN_THRESHOLD = 0.25
+    RED_MAX_THRESHOLD = 0.75
+    RED_MAX_PROBABILITY = 0.1
+    RED_WEIGHT = 0.002
+
+    def __init__(self, max_size, levels=3, drop_policy='tail', random_source=None):
+        self.priority_queues = [deque() for level in range(levels)]
         self.max_size = max_size
-        self.delayed_packet = None
-        self.delay_start = None
+        self.drop_policy = drop_policy
+        self.random_source = random_source if random_source is not None else RandomSource()
+        self.uniform_values = []
+        self.uniform_index = 0
 
-    def queue_packet(self, packet, delay, drop_prob):
-        if packet.priority == 1:
-            if len(self.priority_queue1) < self.max_size:
-                self.priority_queue1.append([packet, delay, drop_prob])
-            else:
-                log_event('Priority queue 1 was full', packet)
-        elif packet.priority == 2:
-            if len(self.priority_queue2) < self.max_size:
-                self.priority_queue2.append([packet, delay, drop_prob])
-            else:
-                log_event('Priority queue 2 was full', packet)
-        elif packet.priority == 3:
-            if len(self.priority_queue3) < self.max_size:
-                self.priority_queue3.append([packet, delay, drop_prob])
-            else:
-                log_event('Priority queue 3 was full', packet)
+        self.average_sizes = [0.0] * levels
+        self.enqueued = [0] * levels
+        self.dropped = [0] * levels
+        self.forwarded = [0] * levels
 
-    def get_next_packet(self):
-        if len(self.priority_queue1) > 0:
-            return self.priority_queue1.pop(0)
-        elif len(self.priority_queue2) > 0:
-            return self.priority_queue2.pop(0)
-        elif len(self.priority_queue3) > 0:
-            return self.priority_queue3.pop(0)
-        else:
-            return None
+        # Packets on the link, ordered by release time: (release_time, order, packet)
+        self.delayed_packets = []
+        self.delayed_count = 0
+        self.link_free_at = 0
+        self.queueing_delay = program_metrics.get_histogram('queueing_delay')
+
+    def queue_packet(self, packet, forwarding_entry, now):
+        level = packet.priority - 1
+        if level < 0 or level >= len(self.priority_queues):
+            log_event('Unknown priority level', packet)
+            return
+
+        priority_queue = self.priority_queues[level]
+
+        if self.drop_policy == 'red' and self.should_drop_early(level):
+            self.dropped[level] += 1
+            log_event('Random early drop from priority queue ' + str(packet.priority), packet)
+            return
+
+        if len(priority_queue) >= self.max_size:
+            self.dropped[level] += 1
+
+            if self.drop_policy != 'oldest' or len(priority_queue) == 0:
+                log_event('Priority queue ' + str(packet.priority) + ' was full', packet)
+                return
+
+            log_event('Priority queue ' + str(packet.priority) + ' was full', priority_queue.popleft()[0])
+
+        priority_queue.append([packet, forwarding_entry, now])
+        self.enqueued[level] += 1
+
+    def should_drop_early(self, level):
+        weight = self.RED_WEIGHT
+        self.average_sizes[level] = (1 - weight) * self.average_sizes[level] + weight * len(self.priority_queues[level])
 
-    def update_queue(self):
-        if self.delayed_packet is None:
-            self.delayed_packet = self.get_next_packet()
-            self.delay_start = int(time.time() * 1000)
+        min_threshold = self.RED_MIN_THRESHOLD * self.max_size
+        max_threshold = self.RED_MAX_THRESHOLD * self.max_size
+        average_size = self.average_sizes[level]
 
-        if self.delayed_packet is not None:
-            if int(time.time() * 1000) - self.delay_start >= self.delayed_packet[1]:
-                packet = self.delayed_packet[0]
-                packet.drop_prob = self.delayed_packet[2]
+        if average_size < min_threshold:
+            return False
+        if average_size >= max_threshold:
+            return True
 
-                self.delayed_packet = None
-                self.delay_start = None
+        drop_probability = self.RED_MAX_PROBABILITY * (average_size - min_threshold) / (max_threshold - min_threshold)
+        return self.get_uniform() < drop_probability
 
-                return packet
+    def get_uniform(self):
+        if self.uniform_index == len(self.uniform_values):
+            self.uniform_values = self.random_source.get_uniform_block()
+            self.uniform_index = 0
+
+        value = self.uniform_values[self.uniform_index]
+        self.uniform_index += 1
+        return value
+
+    def get_next_packet(self):
+        for level, priority_queue in enumerate(self.priority_queues):
+            if len(priority_queue) > 0:
+                self.forwarded[level] += 1
+                return priority_queue.popleft()
 
         return None
 
+    def get_stats(self):
+        return [{'priority': level + 1,
+                 'queued': len(priority_queue),
+                 'enqueued': self.enqueued[level],
+                 'dropped': self.dropped[level],
+                 'forwarded': self.forwarded[level]}
+                for level, priority_queue in enumerate(self.priority_queues)]
+
+    def print_stats(self):
+        print('----------Queue Stats----------')
+        for stats in self.get_stats():
+            print('priority level: ', stats['priority'])
+            print('queued:         ', stats['queued'])
+            print('enqueued:       ', stats['enqueued'])
+            print('dropped:        ', stats['dropped'])
+            print('forwarded:      ', stats['forwarded'])
+            print()
+
+    def has_queued_packets(self):
+        return any(len(priority_queue) > 0 for priority_queue in self.priority_queues)
+
+    def transmit_packets(self, now):
+        while self.link_free_at <= now:
+            next_packet = self.get_next_packet()
+            if next_packet is None:
+                return
+
+            packet, forwarding_entry, arrival_time = next_packet
+            packet.link_model = forwarding_entry.link_model
+
+            transmit_time = max(self.link_free_at, arrival_time)
+            self.queueing_delay.record(transmit_time - arrival_time)
+            self.link_free_at = transmit_time + forwarding_entry.get_serialization_delay(packet)
+            if packet.link_model.should_reorder():
+                release_time = self.link_free_at
+            else:
+                release_time = forwarding_entry.delay_model.get_release_time(self.link_free_at)
+
+            heapq.heappush(self.delayed_packets, (release_time, self.delayed_count, packet))
+            self.delayed_count += 1
+
+    def update_queue(self, now):
+        self.transmit_packets(now)
 
-class Packet:
-    def __init__(self, packet, from_address):
-        outer_header = packet[:17]
-        inner_header = packet[17:26]
+        released_packets = []
+        while len(self.delayed_packets) > 0 and self.delayed_packets[0][0] <= now:
+            released_packets.append(heapq.heappop(self.delayed_packets)[2])
 
-        self.priority, self.int_src_ip, self.src_port, self.int_dest_ip, self.dest_port, self.outer_length = struct.unpack("!BIHIHI", outer_header)
-        self.src_ip = self.convert_int_to_ip(self.int_src_ip)
-        self.src_hostname = socket.gethostbyaddr(self.src_ip)[0]
-        self.dest_ip = self.convert_int_to_ip(self.int_dest_ip)
-        self.dest_hostname = socket.gethostbyaddr(self.dest_ip)[0]
+        return released_packets
 
-        self.type, self.seq_num, self.length = struct.unpack("!cII", inner_header)
-        self.type = str(self.type, 'UTF-8')
-        self.seq_num = socket.ntohl(self.seq_num)
+    def get_next_deadline(self):
+        deadline = self.delayed_packets[0][0] if len(self.delayed_packets) > 0 else None
 
-        self.data = packet[26:]
-        self.data = self.data.decode() if len(self.data) > 0 else ''
+        if self.has_queued_packets() and (deadline is None or self.link_free_at < deadline):
+            deadline = self.link_free_at
+
+        return deadline
+
+
+class Packet(wire.PacketView):
+    __slots__ = ('from_address', 'next_hop_address', 'link_model', 'pool_buffer')
+
+    def __init__(self, packet, from_address, pool_buffer):
+        super().__init__(packet)
 
-        self.packet = packet
         self.from_address = from_address
+        self.pool_buffer = pool_buffer
         self.next_hop_address = None
-        self.drop_prob = 0
+        self.link_model = None
 
         if args.d:
             self.print_debug_info()
 
-    def convert_int_to_ip(self, int_ip):
-        return socket.inet_ntoa(struct.pack('!L', int_ip))
+    # Host names are only needed for logging, so they are resolved on first use
+    @property
+    def src_hostname(self):
+        return get_host_name(self.src_ip)
+
+    @property
+    def dest_hostname(self):
+        return get_host_name(self.dest_ip)
 
     def print_debug_info(self):
         print('==============INCOMING PACKET===============')
@@ -115,56 +521,229 @@ class Packet:
         print('Type             ' + str(self.type))
         print('Sequence Number  ' + str(self.seq_num))
         print('Inner Packet Len ' + str(self.length))
-        print('Data:            ' + str(self.data[:4]))
+        print('Data:            ' + str(bytes(self.payload[:4])))
         print('From Addr        ' + str(self.from_address[0]))
         print('From Port        ' + str(self.from_address[1]))
         print('============================================')
         print('')
 
 
+class HostNameCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # ip -> (host name, expiry time), least recently used first
+        self.host_names = OrderedDict()
+        # The log writer thread and debug output in the forwarding loop both look names up
+        self.lock = threading.Lock()
+
+    def get_host_name(self, ip):
+        now = time.monotonic()
+
+        with self.lock:
+            cached = self.host_names.get(ip)
+            if cached is not None and cached[1] > now:
+                self.host_names.move_to_end(ip)
+                return cached[0]
+
+        try:
+            host_name = socket.gethostbyaddr(ip)[0]
+        except OSError:
+            host_name = ip
+
+        with self.lock:
+            self.host_names[ip] = (host_name, now + self.ttl)
+            self.host_names.move_to_end(ip)
+            if len(self.host_names) > self.max_size:
+                self.host_names.popitem(last=False)
+
+        return host_name
+
+
+# Writes loss events to the log on a background thread so a burst of drops never stalls forwarding. The
+# forwarding loop only copies the header fields it needs (the packet's buffer goes back to the pool right
+# after) and queues them; the writer thread resolves host names, formats one JSON object per line and
+# writes records in batches, flushing once the queue runs dry or FLUSH_INTERVAL has passed. With a rate
+# limit, each reason logs at most that many events per second and a summary of how many were suppressed.
+class EventLogger:
+    BATCH_SIZE = 256
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, filename, rate_limit=0):
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.rate_limit = rate_limit
+        # reason -> [second, events logged, events suppressed]
+        self.reason_counts = {}
+        self.records = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+
+    def log(self, reason, packet):
+        now = time.time()
+        if self.rate_limit > 0 and not self.should_log(reason, int(now)):
+            return
+
+        self.records.put((now, reason, packet.int_src_ip, packet.src_port, packet.int_dest_ip,
+                          packet.dest_port, packet.priority, packet.outer_length))
+
+    def should_log(self, reason, second):
+        counts = self.reason_counts.get(reason)
+        if counts is None or counts[0] != second:
+            if counts is not None and counts[2] > 0:
+                self.records.put((time.time(), reason, counts[2]))
+            counts = self.reason_counts[reason] = [second, 0, 0]
+
+        if counts[1] >= self.rate_limit:
+            counts[2] += 1
+            return False
+
+        counts[1] += 1
+        return True
+
+    def write_records(self):
+        last_flush = time.monotonic()
+        dirty = False
+
+        while True:
+            try:
+                record = self.records.get(timeout=self.FLUSH_INTERVAL if dirty else None)
+            except queue.Empty:
+                record = None
+
+            if record is not None:
+                if record == 'stop':
+                    break
+
+                batch = [record]
+                while len(batch) < self.BATCH_SIZE:
+                    try:
+                        batch.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = batch[-1] == 'stop'
+                if stop:
+                    batch.pop()
+                self.file.write(''.join(self.format_record(record) for record in batch))
+                dirty = True
+
+                if stop:
+                    break
+
+            now = time.monotonic()
+            if dirty and (self.records.empty() or now - last_flush >= self.FLUSH_INTERVAL):
+                self.file.flush()
+                last_flush = now
+                dirty = False
+
+        self.file.close()
+
+    def format_record(self, record):
+        time_of_loss = datetime.fromtimestamp(record[0]).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+        if len(record) == 3:
+            return json.dumps({'time': time_of_loss, 'reason': record[1], 'suppressed': record[2]}) + '\n'
+
+        return json.dumps({'time': time_of_loss,
+                           'reason': record[1],
+                           'source host': get_host_name(wire.convert_int_to_ip(record[2])),
+                           'source port': record[3],
+                           'dest host': get_host_name(wire.convert_int_to_ip(record[4])),
+                           'dest port': record[5],
+                           'priority level': record[6],
+                           'payload size': record[7]}) + '\n'
+
+    def close(self):
+        # Writes out everything still queued
+        for reason, counts in self.reason_counts.items():
+            if counts[2] > 0:
+                self.records.put((time.time(), reason, counts[2]))
+        self.reason_counts = {}
+
+        self.records.put('stop')
+        self.writer.join()
+
 
 class EmulatorSocket:
-    def __init__(self, listening_port_num):
-        self.listen_address = (socket.gethostbyname(socket.gethostname()), listening_port_num)
+    def __init__(self, listening_port_num, host_name, reuse_port=False):
+        self.listen_address = (socket.gethostbyname(host_name), listening_port_num)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(self.listen_address)
-        self.socket.settimeout(0)
+        self.socket.setblocking(False)
+
+        self.batch_socket = batch_io.BatchSocket(self.socket)
+        self.queued_packets = []
 
     def send_packet(self, packet):
-        self.socket.sendto(packet.packet, packet.next_hop_address)
+        self.batch_socket.queue_send(packet.buffer, packet.next_hop_address, packet)
+        self.queued_packets.append(packet)
+
+    def send_duplicate(self, packet):
+        # Sent from the same buffer, which is only released once
+        self.batch_socket.queue_send(packet.buffer, packet.next_hop_address, packet)
 
-    def await_packet(self):
-        full_packet, from_address = self.socket.recvfrom(5500)
+    def flush(self):
+        for packet in self.batch_socket.flush():
+            log_event('Send buffer was full', packet)
 
-        return Packet(full_packet, from_address)
+        # The datagrams have been handed to the kernel, so their buffers can take new packets
+        for packet in self.queued_packets:
+            self.batch_socket.release(packet.pool_buffer)
+        self.queued_packets = []
+
+    def await_packets(self):
+        return [Packet(memoryview(buffer)[:length], from_address, buffer)
+                for buffer, length, from_address in self.batch_socket.receive_batch()]
 
 
 def get_args():
-    parser = argparse.ArgumentParser(usage="emulator.py -p <port> -q <queue_size> -f <filename> -l <log>")
+    parser = argparse.ArgumentParser(usage="emulator.py -p <port> -q <queue_size> -f <filename> -l <log> "
+                                           "[-n <levels>] [-m <drop_policy>] [-c <name_cache_size>] [-r <log_rate_limit>] "
+                                           "[-s <seed>] [-w <workers>] [-u <host_name>] "
+                                           "[-x <metrics_file>]")
 
     parser.add_argument('-p', choices=range(2050, 65536), type=int,
                         help='Port number emulator should wait for packets on', required=True)
     parser.add_argument('-q', type=int, help='Size of each queue', required=True)
     parser.add_argument('-f', type=str, help='Name of the file containing the static forwarding table', required=True)
     parser.add_argument('-l', type=str, help='Name of the log file', required=True)
+    parser.add_argument('-n', type=int, default=3, help='Number of priority levels', required=False)
+    parser.add_argument('-m', choices=['tail', 'red', 'oldest'], default='tail',
+                        help='Drop policy used when a queue is full', required=False)
+    parser.add_argument('-c', type=int, default=256,
+                        help='Host names cached for logging, 0 logs raw IP addresses', required=False)
+    parser.add_argument('-r', type=int, default=0,
+                        help='Events logged per second for each loss reason, 0 logs every event', required=False)
+    parser.add_argument('-s', type=int, help='Seed for loss, duplication, reordering, delays and RED drops',
+                        required=False)
+    parser.add_argument('-w', type=int, default=1,
+                        help='Worker processes sharing the port. Every worker has its own queues and links, so -q '
+                             'and the bandwidth column apply to each of them', required=False)
+    parser.add_argument('-u', type=str, default=socket.gethostname(),
+                        help='Host name to listen on and to match in the forwarding table', required=False)
+    parser.add_argument('-x', type=str, help='File to write a metrics snapshot to every second, '
+                                             'with the worker number appended when there are several',
+                        required=False)
     parser.add_argument('-d', type=bool, default=False, help='Debug mode', required=False)
 
     return parser.parse_args()
 
 
+def get_host_name(ip):
+    if host_name_cache is None:
+        return ip
+
+    return host_name_cache.get_host_name(ip)
+
+
 def log_event(message, packet):
-    logging.warning('reason: ' + message +
-                    ' source host: ' + packet.src_hostname +
-                    ' source port: ' + str(packet.src_port) +
-                    ' dest host: ' + packet.dest_hostname +
-                    ' dest port: ' + str(packet.dest_port) +
-                    ' time of loss: ' + str(datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]) +
-                    ' priority level: ' + str(packet.priority) +
-                    ' payload size: ' + str(packet.outer_length))
+    program_metrics.increment('dropped: ' + message)
+    event_logger.log(message, packet)
 
 
-def load_forwarding_table(filename, port):
-    forwarding_entries = []
+def load_forwarding_table(filename, host_name, port):
+    forwarding_table = ForwardingTable()
 
     try:
         file = open(filename, 'r')
@@ -174,21 +753,26 @@ def load_forwarding_table(filename, port):
 
     lines = file.readlines()
     for line in lines:
-        cols = line.split(' ')
+        cols = line.split()
+        if len(cols) == 0:
+            continue
 
-        if cols[0] == socket.gethostname() and int(cols[1]) == port:
-            forwarding_entries.append(ForwardingEntry(cols))
+        if cols[0] == host_name and int(cols[1]) == port:
+            try:
+                forwarding_table.add_entry(ForwardingEntry(cols))
+            except (OSError, ValueError) as e:
+                print('Invalid forwarding entry "' + line.strip() + '": ' + str(e))
+                exit(-1)
 
-    return forwarding_entries
+    return forwarding_table
 
 
 def get_forwarding_entry(packet, forwarding_table):
-    for forwarding_entry in forwarding_table:
-        if forwarding_entry.destination_host_name == packet.dest_hostname and forwarding_entry.destination_port == packet.dest_port:
-            packet.next_hop_address = (socket.gethostbyname(forwarding_entry.next_hop_host_name), forwarding_entry.next_hop_port)
-            return forwarding_entry
+    forwarding_entry = forwarding_table.lookup(packet.int_dest_ip, packet.dest_port)
+    if forwarding_entry is not None:
+        packet.next_hop_address = forwarding_entry.next_hop_address
 
-    return None
+    return forwarding_entry
 
 
 def should_send(outgoing_packet):
@@ -198,38 +782,127 @@ def should_send(outgoing_packet):
     if outgoing_packet.type == 'E':
         return True
 
-    if random.randint(1, 100) <= int(outgoing_packet.drop_prob):
+    if outgoing_packet.link_model.should_drop():
         log_event('Loss event occurred', outgoing_packet)
         return False
 
     return True
 
 
-def listen_for_packets(forwarding_table, emulator_socket, args):
-    forwarding_queue = ForwardingQueue(args.q)
-
+def receive_packets(forwarding_table, forwarding_queue, emulator_socket):
     while True:
-        try:
-            incoming_packet = emulator_socket.await_packet()
+        incoming_packets = emulator_socket.await_packets()
+        if len(incoming_packets) == 0:
+            return
 
+        now = time.monotonic()
+        for incoming_packet in incoming_packets:
             forwarding_entry = get_forwarding_entry(incoming_packet, forwarding_table)
             if forwarding_entry is not None:
-                forwarding_queue.queue_packet(incoming_packet, forwarding_entry.delay, forwarding_entry.loss_probability)
+                forwarding_queue.queue_packet(incoming_packet, forwarding_entry, now)
             else:
                 log_event('No forwarding entry found', incoming_packet)
 
-        except BlockingIOError as e:
-            pass
 
-        outgoing_packet = forwarding_queue.update_queue()
+def release_packets(forwarding_queue, emulator_socket):
+    for outgoing_packet in forwarding_queue.update_queue(time.monotonic()):
         if should_send(outgoing_packet):
             emulator_socket.send_packet(outgoing_packet)
+            program_metrics.increment('forwarded')
+            if outgoing_packet.link_model.should_duplicate():
+                emulator_socket.send_duplicate(outgoing_packet)
+                program_metrics.increment('duplicated')
+
+    emulator_socket.flush()
+
+
+def listen_for_packets(forwarding_table, emulator_socket, args, worker=0):
+    global event_logger
+    forwarding_table.seed(args.s, worker)
+    # Started here rather than before forking, since the writer thread would not survive into the workers
+    event_logger = EventLogger(args.l, args.r)
+    if args.x is not None:
+        program_metrics.start_snapshots(args.x if args.w <= 1 else args.x + '.' + str(worker))
+
+    # Seeded apart from every forwarding entry's streams, whose keys are longer
+    forwarding_queue = ForwardingQueue(args.q, args.n, args.m,
+                                       RandomSource(None if args.s is None else (args.s, worker)))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: forwarding_queue.print_stats())
+    # Stop through SystemExit so the events still queued for the log get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    selector = selectors.DefaultSelector()
+    selector.register(emulator_socket.socket, selectors.EVENT_READ)
+
+    try:
+        while True:
+            deadlines = [forwarding_queue.get_next_deadline(), program_metrics.get_next_snapshot_time()]
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            timeout = max(0, min(deadlines) - time.monotonic()) if len(deadlines) > 0 else None
+
+            if selector.select(timeout):
+                receive_packets(forwarding_table, forwarding_queue, emulator_socket)
+
+            release_packets(forwarding_queue, emulator_socket)
+            program_metrics.write_due_snapshot(time.monotonic())
+    finally:
+        # A second signal must not cut the final writes short. Ctrl-C reaches every worker twice, once from the
+        # terminal and once forwarded by the parent.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        event_logger.close()
+        program_metrics.write_snapshot()
+
+
+def run_workers(forwarding_table, args):
+    # Each worker binds its own socket to the shared port and the kernel spreads datagrams across them by a
+    # hash of the sending address, so all packets from one flow are handled by the same worker and stay in
+    # order. The forwarding table was loaded before forking and is shared copy-on-write.
+    # Every worker runs its own ForwardingQueue, so the -q limit and each entry's bandwidth apply per worker:
+    # traffic spread across N workers sees up to N times the queue space and link rate. A single flow is only
+    # ever handled by one worker and sees exactly the configured values.
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        print('Multiple workers need fork and SO_REUSEPORT, which this platform does not provide')
+        exit(-1)
+
+    worker_pids = []
+    for worker in range(args.w):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                listen_for_packets(forwarding_table, EmulatorSocket(args.p, args.u, True), args, worker)
+            finally:
+                os._exit(0)
+
+        worker_pids.append(pid)
+
+    def forward_signal(signum, frame):
+        for worker_pid in worker_pids:
+            try:
+                os.kill(worker_pid, signum)
+            except ProcessLookupError:
+                pass
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, forward_signal)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, forward_signal)
+
+    for worker_pid in worker_pids:
+        os.waitpid(worker_pid, 0)
 
 
 if __name__ == '__main__':
     args = get_args()
 
-    logging.basicConfig(filename=args.l, encoding='utf-8', filemode='w')
-    forwarding_table = load_forwarding_table(args.f, args.p)
+    # Every process appends its own events, so the log is truncated once up front
+    open(args.l, 'w').close()
+    if args.c > 0:
+        host_name_cache = HostNameCache(args.c, HOST_NAME_TTL)
+
+    forwarding_table = load_forwarding_table(args.f, args.u, args.p)
 
-    listen_for_packets(forwarding_table, EmulatorSocket(args.p), args)
\ No newline at end of file
+    if args.w > 1:
+        run_workers(forwarding_table, args)
+    else:
+        listen_for_packets(forwarding_table, EmulatorSocket(args.p, args.u), args)
\ No newline at end of file
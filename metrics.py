@@ -0,0 +1,95 @@
+import json
+import math
+import os
+import time
+
+# Histogram bucket i counts values below 2**i microseconds, the last bucket takes everything larger
+BUCKET_COUNT = 40
+SNAPSHOT_INTERVAL = 1.0
+
+
+# Durations bucketed by powers of two, so recording one is an int conversion and a list increment
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        microseconds = int(seconds * 1_000_000)
+        self.buckets[min(microseconds.bit_length(), BUCKET_COUNT - 1) if microseconds > 0 else 0] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def get_percentile(self, percentile):
+        # Upper bound of the bucket holding the percentile, in seconds
+        if self.count == 0:
+            return None
+
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(2 ** index / 1_000_000, self.max)
+
+    def get_snapshot(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count > 0 else None,
+                'max': self.max,
+                'p50': self.get_percentile(50),
+                'p90': self.get_percentile(90),
+                'p99': self.get_percentile(99),
+                # Upper bound in microseconds -> count, for the buckets that are in use
+                'buckets': {str(2 ** index): count for index, count in enumerate(self.buckets) if count > 0}}
+
+
+# Counters and histograms of one program. When a snapshot file is set, the program's event loop calls
+# write_due_snapshot() and the file is replaced with the current values every SNAPSHOT_INTERVAL seconds.
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.snapshot_filename = None
+        self.next_snapshot_time = None
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get_histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+
+        return histogram
+
+    def start_snapshots(self, filename):
+        self.snapshot_filename = filename
+        self.next_snapshot_time = time.monotonic()
+
+    def get_next_snapshot_time(self):
+        return self.next_snapshot_time
+
+    def write_due_snapshot(self, now):
+        if self.next_snapshot_time is None or now < self.next_snapshot_time:
+            return
+
+        self.write_snapshot()
+        self.next_snapshot_time = now + SNAPSHOT_INTERVAL
+
+    def write_snapshot(self):
+        if self.snapshot_filename is None:
+            return
+
+        snapshot = {'time': time.time(),
+                    'counters': self.counters,
+                    'histograms': {name: histogram.get_snapshot() for name, histogram in self.histograms.items()}}
+
+        # Readers never see a half written file
+        with open(self.snapshot_filename + '.tmp', 'w') as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(self.snapshot_filename + '.tmp', self.snapshot_filename)
@@ -1,8 +1,19 @@
 import argparse
+from collections import deque
 from datetime import datetime
+import json
+import os
+import selectors
 import time
 import socket
-import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import batch_io
+import metrics
+import wire
+
+program_metrics = metrics.Metrics()
 
 
 class SenderStats:
@@ -11,31 +22,115 @@ class SenderStats:
         self.packets_rec = 0
         self.bytes_rec = 0
         self.test_duration = 0
+        self.start_time = 0
 
     def get_average_packets_per_second(self):
-        return round(self.packets_rec / (self.test_duration / 1000))
-
+        # A stripe of a few bytes can finish within the same millisecond it was requested
+        return round(self.packets_rec / (max(self.test_duration, 1) / 1000))
+
+
+# Writes one portion of the file in sequence order as its packets arrive. Packets ahead of the next expected
+# one wait in a buffer bounded by the window size; anything further ahead is refused so the sender resends it.
+# A sequence number the sender gave up on arrives as a skip without data, which lets the packets after it
+# through.
+class ReorderBuffer:
+    def __init__(self, file, offset, capacity):
+        self.file = file
+        self.offset = offset
+        self.capacity = capacity
+        self.next_seq_num = 1
+        self.bytes_written = 0
+        self.pending = {}
+
+    def add_data(self, seq_num, data):
+        if self.has_received(seq_num):
+            return True
+        if seq_num >= self.next_seq_num + self.capacity:
+            return False
+
+        if seq_num != self.next_seq_num:
+            # Received buffers are reused once the batch is handled, so held back data needs its own copy
+            self.pending[seq_num] = bytes(data)
+            return True
+
+        self.write(data)
+        while self.next_seq_num in self.pending:
+            self.write(self.pending.pop(self.next_seq_num))
+
+        return True
+
+    def has_received(self, seq_num):
+        return seq_num < self.next_seq_num or seq_num in self.pending
+
+    def write(self, data):
+        write_at(self.file, data, self.offset + self.bytes_written)
+        self.bytes_written += len(data)
+        self.next_seq_num += 1
+
+    def flush(self):
+        # Whatever is still held back when the sender finishes is written in order
+        for seq_num in sorted(self.pending.keys()):
+            self.write(self.pending.pop(seq_num))
+
+
+# Holds back ACKs for a portion until ack_every packets have arrived or ack_delay has passed since the first
+# unacknowledged one, then a single cumulative ACK with a selective bitmap covers all of them.
+class DelayedAck:
+    def __init__(self, ack_every, ack_delay):
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.unacked_packets = 0
+        self.deadline = None
+
+    def add_packet(self, now):
+        self.unacked_packets += 1
+        if self.deadline is None:
+            self.deadline = now + self.ack_delay
+
+        return self.unacked_packets >= self.ack_every
+
+    def reset(self):
+        self.unacked_packets = 0
+        self.deadline = None
+
+
+# A byte range of one portion and the replicas that can send it, in the order they are tried. The range is
+# (offset, length) within the portion with None as the length for everything after the offset, or None to
+# request the whole portion.
+class Stripe:
+    def __init__(self, file_portion, replicas, byte_range):
+        self.file_portion = file_portion
+        self.replicas = replicas
+        self.replica_index = 0
+        self.byte_range = byte_range
+        self.reorder_buffer = None
+        self.delayed_ack = None
+        self.sender_stats = None
+        self.last_packet_time = None
+
+    @property
+    def sender_address(self):
+        return self.replicas[self.replica_index]
+
+    def get_remaining_range(self):
+        start, length = self.byte_range if self.byte_range is not None else (0, None)
+        bytes_written = self.reorder_buffer.bytes_written
+
+        return start + bytes_written, None if length is None else length - bytes_written
+
+
+class Packet(wire.PacketView):
+    __slots__ = ()
 
-class Packet:
     def __init__(self, packet):
-        outer_header = packet[:17]
-        inner_header = packet[17:26]
-
-        self.priority, self.src_ip, self.src_port, self.dest_ip, self.dest_port, self.outer_length = struct.unpack("!BIHIHI", outer_header)
-        self.type, self.seq_num, self.length = struct.unpack("!cII", inner_header)
-        self.type = str(self.type, 'UTF-8')
-        self.seq_num = socket.ntohl(self.seq_num)
-
-        self.data = packet[26:]
-        self.data = self.data.decode() if len(self.data) > 0 else ''
-
-        self.sender_address = (self.convert_int_to_ip(self.src_ip), self.src_port)
+        super().__init__(packet)
 
         if args.d:
             self.print_debug_info()
 
-    def convert_int_to_ip(self, int_ip):
-        return socket.inet_ntoa(struct.pack('!L', int_ip))
+    @property
+    def sender_address(self):
+        return self.src_ip, self.src_port
 
     def print_packet_info(self):
         print('END', "Packet")
@@ -43,7 +138,7 @@ class Packet:
         print('sender addr:    ', self.sender_address[0] + ':' + str(self.sender_address[1]))
         print('sequence:       ', self.seq_num)
         print('length:         ', self.length)
-        print('payload:        ', self.data[:4])
+        print('payload:        ', bytes(self.payload[:4]))
         print()
 
     def print_debug_info(self):
@@ -57,60 +152,85 @@ class Packet:
         print('Type             ' + str(self.type))
         print('Sequence Number  ' + str(self.seq_num))
         print('Inner Packet Len ' + str(self.length))
-        print('Data:            ' + str(self.data[:4]))
+        print('Data:            ' + str(bytes(self.payload[:4])))
         print('Requester Addr   ' + str(self.sender_address[0]))
         print('Requester Port   ' + str(self.sender_address[1]))
         print('============================================')
         print('')
 
 class RequestSocket:
-    def __init__(self, listening_port_num, filename, window_size, file_table, emulator_address):
-        self.listen_address = (socket.gethostbyname(socket.gethostname()), listening_port_num)
+    def __init__(self, listening_port_num, filename, window_size, emulator_address, host_name):
+        self.listen_address = (socket.gethostbyname(host_name), listening_port_num)
         self.emulator_address = emulator_address
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(self.listen_address)
-        self.socket.settimeout(20)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.batch_socket = batch_io.BatchSocket(self.socket)
+        self.data_buffers = []
 
         self.filename = filename
         self.window_size = window_size
-        self.file_table = file_table
+        self.packet_builders = {}
 
-    def convert_ip_to_int(self, ip_string):
-        return struct.unpack("!L", socket.inet_aton(ip_string))[0]
+    def get_packet_builder(self, sender_address):
+        packet_builder = self.packet_builders.get(sender_address)
+        if packet_builder is None:
+            packet_builder = wire.PacketBuilder(1, self.listen_address, sender_address)
+            self.packet_builders[sender_address] = packet_builder
 
-    def create_outer_header(self, file_portion):
-        int_src_ip = self.convert_ip_to_int(self.listen_address[0])
-        int_dest_ip = self.convert_ip_to_int(file_table[file_portion][0])
-        src_port = self.listen_address[1]
-        dest_port = file_table[file_portion][1]
+        return packet_builder
 
-        return struct.pack("!BIHIHI", 1, int_src_ip, src_port, int_dest_ip, dest_port, 9)
+    def send_request_packet(self, sender_address, byte_range=None):
+        request = self.filename
+        if byte_range is not None:
+            request += '\0' + str(byte_range[0]) + ':' + ('' if byte_range[1] is None else str(byte_range[1]))
 
-    def send_request_packet(self, file_portion):
-        inner_header = struct.pack("!cII", 'R'.encode('ascii'), 0, self.window_size)
-        inner_packet = inner_header + self.filename.encode()
+        packet = self.get_packet_builder(sender_address).build('R', 0, request.encode(), self.window_size)
+        self.send_packet(packet)
 
-        outer_header = self.create_outer_header(file_portion)
-        packet = outer_header + inner_packet
+    def send_ack_packet(self, sender_address, seq_num):
+        packet = self.get_packet_builder(sender_address).build('A', seq_num)
+        self.send_packet(packet)
 
-        self.socket.sendto(packet, emulator_address)
+    def send_cumulative_ack_packet(self, sender_address, seq_num, sack_bitmap):
+        packet = self.get_packet_builder(sender_address).build('C', seq_num, sack_bitmap)
+        self.send_packet(packet)
 
-    def send_ack_packet(self, file_portion, seq_num):
-        inner_header = struct.pack("!cII", 'A'.encode('ascii'), socket.htonl(seq_num), 0)
-        outer_header = self.create_outer_header(file_portion)
+    def send_packet(self, packet):
+        try:
+            self.socket.sendto(packet, self.emulator_address)
+        except BlockingIOError:
+            # Treated like a loss on the network: the sender resends whatever was not acknowledged and a lost
+            # request is handled by the stall timeout
+            pass
 
-        packet = outer_header + inner_header
-        self.socket.sendto(packet, emulator_address)
+    def await_data(self, timeout):
+        if len(self.selector.select(timeout)) == 0:
+            return []
 
-    def await_data(self):
-        packet, sender_address = self.socket.recvfrom(5300)
-        return Packet(packet)
+        packets = []
+        while True:
+            datagrams = self.batch_socket.receive_batch()
+            if len(datagrams) == 0:
+                return packets
+
+            for buffer, length, sender_address in datagrams:
+                self.data_buffers.append(buffer)
+                packets.append(Packet(memoryview(buffer)[:length]))
+
+    def release_data(self):
+        for buffer in self.data_buffers:
+            self.batch_socket.release(buffer)
+        self.data_buffers = []
 
 
 def get_args():
     parser = argparse.ArgumentParser(usage="requester.py -p <port> -o <file option> -f <f_hostname> -e <f_port> "
-                                           "-w <window>")
+                                           "-w <window> [-a <ack_every>] [-t <ack_delay>] [-r <tracker>] "
+                                           "[-s <stall_timeout>] [-u <host_name>] [-x <metrics_file>] [-v]")
 
     parser.add_argument('-p', choices=range(2050, 65536), type=int,
                         help='Port number on which to wait for packets', required=True)
@@ -119,28 +239,95 @@ def get_args():
     parser.add_argument('-f', type=str, help='Host name of the emulator', required=True)
     parser.add_argument('-e', choices=range(2050, 65536), type=int, help='the port of the emulator.', required=True)
     parser.add_argument('-w', type=int, help='Requester\'s window size', required=True)
+    parser.add_argument('-a', type=int, default=1,
+                        help='Packets covered by each cumulative ACK, 1 acknowledges every packet on its own',
+                        required=False)
+    parser.add_argument('-t', type=int, default=10, help='Longest time a cumulative ACK is held back in milliseconds',
+                        required=False)
+    parser.add_argument('-r', type=str, default='tracker.txt', help='Path of the tracker file', required=False)
+    parser.add_argument('-s', type=float, default=5,
+                        help='Seconds without data from a sender before its share is requested from another replica',
+                        required=False)
+    parser.add_argument('-u', type=str, default=socket.gethostname(), help='Host name to listen on', required=False)
+    parser.add_argument('-x', type=str, help='File to write a metrics snapshot to every second', required=False)
+    parser.add_argument('-v', action='store_true', help='Print every END packet received', required=False)
     parser.add_argument('-d', type=bool, default=False, help='Debug mode', required=False)
 
     return parser.parse_args()
 
 
-def load_file_table(filename):
+def build_tracker_index(tracker_filename):
+    # filename -> portion -> [[replica (host name, port), ...], portion size or None]
+    tracker_index = {}
+
+    with open(tracker_filename, 'r') as file:
+        for line in file:
+            cols = line.split()
+            if len(cols) < 4:
+                continue
+
+            portion = tracker_index.setdefault(cols[0], {}).setdefault(int(cols[1]), [[], None])
+            replica = (cols[2], int(cols[3]))
+            if replica not in portion[0]:
+                portion[0].append(replica)
+
+            # An optional fifth column gives the size of the portion in bytes
+            if len(cols) > 4 and portion[1] is None:
+                portion[1] = int(cols[4])
+
+    return tracker_index
+
+
+def load_tracker_index(tracker_filename):
+    # The parsed tracker is saved as JSON next to it and only rebuilt when the tracker's size or modification
+    # time change. A tracker in a read-only directory is simply parsed every time.
+    tracker_stat = os.stat(tracker_filename)
+    tracker_version = (tracker_stat.st_mtime_ns, tracker_stat.st_size)
+    index_filename = tracker_filename + '.index'
+
+    try:
+        with open(index_filename, 'r') as file:
+            index = json.load(file)
+        if index['version'] == list(tracker_version):
+            # JSON object keys are always strings
+            return {filename: {int(file_portion): portion for file_portion, portion in portions.items()}
+                    for filename, portions in index['files'].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    tracker_index = build_tracker_index(tracker_filename)
+    try:
+        with open(index_filename + '.tmp', 'w') as file:
+            json.dump({'version': tracker_version, 'files': tracker_index}, file)
+        os.replace(index_filename + '.tmp', index_filename)
+    except OSError:
+        pass
+
+    return tracker_index
+
+
+def load_file_table(tracker_filename, filename):
     file_locations = {}
+    portion_sizes = {}
 
     try:
-        file = open('tracker.txt', 'r')
+        tracker_index = load_tracker_index(tracker_filename)
     except IOError as e:
         print(str(e))
         exit(-1)
 
-    lines = file.readlines()
-    for line in lines:
-        cols = line.split(' ')
+    # Only the hosts holding this file are resolved
+    host_addresses = {}
+    for file_portion, (replicas, portion_size) in tracker_index.get(filename, {}).items():
+        for host_name, port in replicas:
+            if host_name not in host_addresses:
+                host_addresses[host_name] = socket.gethostbyname(host_name)
 
-        if cols[0] == filename:
-            file_locations[int(cols[1])] = (socket.gethostbyname(cols[2]), int(cols[3].strip()))
+        file_locations[file_portion] = [(host_addresses[host_name], port) for host_name, port in replicas]
+        if portion_size is not None:
+            portion_sizes[file_portion] = portion_size
 
-    return file_locations
+    return file_locations, portion_sizes
 
 
 def print_sender_stats(senders):
@@ -154,64 +341,321 @@ def print_sender_stats(senders):
         print()
 
 
-def write_file(packets, filename):
-    file = open(filename, 'w')
-    sorted_keys = list(packets.keys())
-    sorted_keys.sort()
-
-    for key in sorted_keys:
-        data = packets[key]
+def write_at(file, data, offset):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(file.fileno(), data, offset)
+    else:
+        file.seek(offset)
         file.write(data)
 
-    file.close()
 
+def get_portion_offsets(file_portions, portion_sizes):
+    # A portion can be written straight into the output file once the sizes of all portions before it are known
+    offsets = {}
+    offset = 0
+    for file_portion in sorted(file_portions):
+        offsets[file_portion] = offset
+        if file_portion not in portion_sizes:
+            break
 
-def request_file(request_socket):
-    file_data = {}
-    senders = []
+        offset += portion_sizes[file_portion]
 
-    for file_portion in range(1, len(file_table) + 1):
-        sender_stats = SenderStats()
-        start_time = int(time.time() * 1000)
+    return offsets
 
-        request_socket.send_request_packet(file_portion)
-        while True:
-            try:
-                packet = request_socket.await_data()
-            except TimeoutError:
-                print('Detected lost packet after 20 seconds. Please try again')
-                exit(-1)
-
-            if packet.convert_int_to_ip(packet.dest_ip) == request_socket.listen_address[0] \
-                    and packet.dest_port == request_socket.listen_address[1]:
-                sender_stats.address = packet.sender_address
-                sender_stats.bytes_rec += packet.length
-
-                if packet.type == 'E':
-                    packet.print_packet_info()
+
+def open_portion_file(output_file, filename, file_portion, offsets):
+    # Returns the file a portion is written to and the portion's offset in it
+    if file_portion in offsets:
+        return output_file, offsets[file_portion]
+
+    return open(get_part_filename(filename, file_portion), 'w+b', buffering=0), 0
+
+
+def split_portion(file_portion, replicas, portion_size):
+    # A portion of known size is striped across its replicas, each stripe first requested from a different one.
+    # Stripe sizes differ by at most one byte and none is empty, so a tiny portion uses fewer replicas.
+    stripe_count = min(len(replicas), portion_size) if portion_size is not None else 1
+    if stripe_count <= 1:
+        return [Stripe(file_portion, replicas, None)]
+
+    stripe_len, longer_stripes = divmod(portion_size, stripe_count)
+    stripes = []
+    start = 0
+    for index in range(stripe_count):
+        length = stripe_len + 1 if index < longer_stripes else stripe_len
+        stripes.append(Stripe(file_portion, replicas[index:] + replicas[:index], (start, length)))
+        start += length
+
+    return stripes
+
+
+def get_part_filename(filename, file_portion):
+    return filename + '.part' + str(file_portion)
+
+
+def assemble_file(output_file, filename, portion_files, portion_ends):
+    # Portions whose offset was not known up front were written to part files and are copied in here
+    offset = 0
+    for file_portion in sorted(portion_files.keys()):
+        portion_file = portion_files[file_portion][0]
+
+        if portion_file is not output_file:
+            portion_file.seek(0)
+            while True:
+                data = portion_file.read(1024 * 1024)
+                if len(data) == 0:
                     break
 
-                if packet.type != 'E':
-                    file_data[(file_portion, packet.seq_num)] = packet.data
-                    sender_stats.packets_rec += 1
-                    request_socket.send_ack_packet(file_portion, packet.seq_num)
+                write_at(output_file, data, offset)
+                offset += len(data)
+
+            portion_file.close()
+            os.remove(get_part_filename(filename, file_portion))
+        else:
+            offset = portion_ends[file_portion]
+
+    output_file.truncate(offset)
+
+
+# Downloads every portion of a file at once. Stripes are matched to packets by sender address, so a sender
+# holding more than one stripe serves them one after another. A sender that goes quiet for stall_timeout is
+# treated as slow: what is left of its stripes is requested from their next replica and nothing more is asked
+# of it, since it would ignore new requests while it still has a transfer to us running.
+class FileDownload:
+    def __init__(self, request_socket, file_table, portion_sizes, ack_every, ack_delay, stall_timeout, verbose):
+        self.request_socket = request_socket
+        self.verbose = verbose
+        self.inter_arrival = program_metrics.get_histogram('inter_arrival')
+        self.last_arrival_time = None
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay / 1000
+        self.stall_timeout = stall_timeout
+        self.output_file = open(request_socket.filename, 'w+b', buffering=0)
+        self.offsets = get_portion_offsets(file_table.keys(), portion_sizes)
+
+        self.stripes = []
+        for file_portion in sorted(file_table.keys()):
+            self.stripes += split_portion(file_portion, file_table[file_portion], portion_sizes.get(file_portion))
+
+        self.portion_files = {}
+        self.reorder_buffers = []
+        self.senders = []
+
+        self.pending_stripes = {}
+        self.active_stripes = {}
+        self.slow_senders = set()
+
+    def start(self):
+        for stripe in self.stripes:
+            self.queue_stripe(stripe)
+
+    def is_complete(self):
+        return len(self.active_stripes) == 0 and all(len(pending) == 0 for pending in self.pending_stripes.values())
+
+    def queue_stripe(self, stripe):
+        sender_address = stripe.sender_address
+        if sender_address in self.active_stripes:
+            self.pending_stripes.setdefault(sender_address, deque()).append(stripe)
+        else:
+            self.start_stripe(stripe)
+
+    def request_next_stripe(self, sender_address):
+        pending = self.pending_stripes.get(sender_address)
+        if pending is not None and len(pending) > 0:
+            self.start_stripe(pending.popleft())
+
+    def start_stripe(self, stripe):
+        file_portion = stripe.file_portion
+        if file_portion not in self.portion_files:
+            self.portion_files[file_portion] = open_portion_file(self.output_file, self.request_socket.filename,
+                                                                 file_portion, self.offsets)
+        portion_file, portion_offset = self.portion_files[file_portion]
+
+        start = stripe.byte_range[0] if stripe.byte_range is not None else 0
+        stripe.reorder_buffer = ReorderBuffer(portion_file, portion_offset + start, self.request_socket.window_size)
+        stripe.delayed_ack = DelayedAck(self.ack_every, self.ack_delay)
+        self.reorder_buffers.append((file_portion, stripe.reorder_buffer))
+
+        stripe.sender_stats = SenderStats()
+        stripe.sender_stats.address = stripe.sender_address
+        stripe.sender_stats.start_time = int(time.time() * 1000)
+        self.senders.append((file_portion, stripe.sender_stats))
+
+        stripe.last_packet_time = time.monotonic()
+        self.active_stripes[stripe.sender_address] = stripe
+        self.request_socket.send_request_packet(stripe.sender_address, stripe.byte_range)
+
+    def handle_packet(self, packet, now):
+        if packet.dest_ip != self.request_socket.listen_address[0] \
+                or packet.dest_port != self.request_socket.listen_address[1]:
+            return
+
+        sender_address = packet.sender_address
+        stripe = self.active_stripes.get(sender_address)
+        if stripe is None:
+            return
+
+        if self.last_arrival_time is not None:
+            self.inter_arrival.record(now - self.last_arrival_time)
+        self.last_arrival_time = now
+
+        stripe.last_packet_time = now
+        sender_stats = stripe.sender_stats
+        sender_stats.bytes_rec += packet.length
+        reorder_buffer = stripe.reorder_buffer
+
+        if packet.type == 'E':
+            if self.verbose:
+                packet.print_packet_info()
+            sender_stats.test_duration = int(time.time() * 1000) - sender_stats.start_time
+            reorder_buffer.flush()
+
+            del self.active_stripes[sender_address]
+            self.request_next_stripe(sender_address)
+            return
+
+        if packet.type == 'S':
+            # Handled like a data packet without data, so it is acknowledged and moves the window on
+            program_metrics.increment('skipped packets')
+        else:
+            sender_stats.packets_rec += 1
+            program_metrics.increment('data packets')
+        is_duplicate = reorder_buffer.has_received(packet.seq_num)
+        if is_duplicate:
+            program_metrics.increment('duplicate packets')
+        if not reorder_buffer.add_data(packet.seq_num, packet.payload):
+            program_metrics.increment('packets beyond window')
+            return
+
+        if self.ack_every <= 1:
+            self.request_socket.send_ack_packet(sender_address, packet.seq_num)
+        elif stripe.delayed_ack.add_packet(now) or is_duplicate:
+            # A duplicate means an earlier ACK was lost, so it is answered straight away
+            self.send_cumulative_ack(stripe)
+
+    def send_cumulative_ack(self, stripe):
+        reorder_buffer = stripe.reorder_buffer
+        cumulative_seq_num = reorder_buffer.next_seq_num - 1
+        sack_bitmap = wire.build_sack_bitmap(cumulative_seq_num, reorder_buffer.pending.keys())
+
+        self.request_socket.send_cumulative_ack_packet(stripe.sender_address, cumulative_seq_num, sack_bitmap)
+        stripe.delayed_ack.reset()
+
+    def get_next_ack_deadline(self):
+        deadlines = [stripe.delayed_ack.deadline for stripe in self.active_stripes.values()
+                     if stripe.delayed_ack.deadline is not None]
+
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def send_due_acks(self, now):
+        for stripe in self.active_stripes.values():
+            if stripe.delayed_ack.deadline is not None and stripe.delayed_ack.deadline <= now:
+                self.send_cumulative_ack(stripe)
+
+    def get_next_stall_deadline(self):
+        if len(self.active_stripes) == 0:
+            return None
+
+        return min(stripe.last_packet_time for stripe in self.active_stripes.values()) + self.stall_timeout
+
+    def get_next_replica_index(self, stripe):
+        for replica_index in range(stripe.replica_index + 1, len(stripe.replicas)):
+            if stripe.replicas[replica_index] not in self.slow_senders:
+                return replica_index
+
+        return None
+
+    def handle_stalled_stripes(self, now):
+        for sender_address, stripe in list(self.active_stripes.items()):
+            if now - stripe.last_packet_time < self.stall_timeout:
+                continue
+
+            stripes = [stripe] + list(self.pending_stripes.get(sender_address, ()))
+            if all(self.get_next_replica_index(waiting_stripe) is not None for waiting_stripe in stripes):
+                self.replace_sender(sender_address, stripes, now)
+            else:
+                # Nowhere else to go, so keep waiting on this sender. If nothing ever arrived the request
+                # itself may have been lost.
+                if stripe.reorder_buffer.next_seq_num == 1 and len(stripe.reorder_buffer.pending) == 0:
+                    self.request_socket.send_request_packet(sender_address, stripe.byte_range)
+                stripe.last_packet_time = now
+
+    def replace_sender(self, sender_address, stripes, now):
+        program_metrics.increment('slow senders')
+        self.slow_senders.add(sender_address)
+        del self.active_stripes[sender_address]
+        self.pending_stripes.pop(sender_address, None)
+
+        # Data held back for reordering is dropped, the next replica resends everything after the last byte
+        # that was written in order
+        stripe = stripes[0]
+        stripe.sender_stats.test_duration = int(time.time() * 1000) - stripe.sender_stats.start_time
+        stripe.byte_range = stripe.get_remaining_range()
+
+        for waiting_stripe in stripes:
+            waiting_stripe.replica_index = self.get_next_replica_index(waiting_stripe)
+            print('No data from ' + sender_address[0] + ':' + str(sender_address[1]) + ' for '
+                  + str(self.stall_timeout) + ' seconds, requesting portion ' + str(waiting_stripe.file_portion)
+                  + ' from ' + waiting_stripe.sender_address[0] + ':' + str(waiting_stripe.sender_address[1]))
+            self.queue_stripe(waiting_stripe)
+        print()
+
+    def finish(self):
+        self.senders.sort(key=lambda sender: sender[0])
+        print_sender_stats([sender_stats for file_portion, sender_stats in self.senders])
+
+        portion_ends = {}
+        for file_portion, reorder_buffer in self.reorder_buffers:
+            portion_ends[file_portion] = max(portion_ends.get(file_portion, 0),
+                                             reorder_buffer.offset + reorder_buffer.bytes_written)
+
+        assemble_file(self.output_file, self.request_socket.filename, self.portion_files, portion_ends)
+        self.output_file.close()
+
 
-        sender_stats.test_duration = int(time.time() * 1000) - start_time
-        senders.append(sender_stats)
+def request_file(request_socket, file_table, portion_sizes, args):
+    download = FileDownload(request_socket, file_table, portion_sizes, args.a, args.t, args.s, args.v)
+    if args.x is not None:
+        program_metrics.start_snapshots(args.x)
+    download.start()
 
-    print_sender_stats(senders)
-    write_file(file_data, request_socket.filename)
+    last_packet_time = time.monotonic()
+    while not download.is_complete():
+        now = time.monotonic()
+        timeout = max(0, last_packet_time + 20 - now)
+        for deadline in (download.get_next_ack_deadline(), download.get_next_stall_deadline(),
+                         program_metrics.get_next_snapshot_time()):
+            if deadline is not None:
+                timeout = min(timeout, max(0, deadline - now))
+
+        packets = request_socket.await_data(timeout)
+        now = time.monotonic()
+        if len(packets) > 0:
+            last_packet_time = now
+        elif now - last_packet_time >= 20:
+            print('Detected lost packet after 20 seconds. Please try again')
+            exit(-1)
+
+        for packet in packets:
+            download.handle_packet(packet, now)
+        request_socket.release_data()
+
+        download.send_due_acks(now)
+        download.handle_stalled_stripes(now)
+        program_metrics.write_due_snapshot(now)
+
+    download.finish()
+    program_metrics.write_snapshot()
 
 
 if __name__ == '__main__':
     args = get_args()
-    file_table = load_file_table(args.o)
+    file_table, portion_sizes = load_file_table(args.r, args.o)
 
     if len(file_table) == 0:
         print("File was not found in the tracker")
         exit(-1)
 
     emulator_address = (socket.gethostbyname(args.f), args.e)
-    request_socket = RequestSocket(args.p, args.o, args.w, file_table, emulator_address)
-    request_file(request_socket)
-
+    request_socket = RequestSocket(args.p, args.o, args.w, emulator_address, args.u)
+    request_file(request_socket, file_table, portion_sizes, args)
@@ -1,76 +1,64 @@
 import argparse
+import heapq
+import math
+import mmap
+import selectors
+import signal
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
 import os
 import socket
 import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import batch_io
+import metrics
+import wire
+
+program_metrics = metrics.Metrics()
+SELECT_RESOLUTION = 0.001
 
 
 class OutgoingPacket:
-    def __init__(self, priority, type, seq_num, data, source_address, destination_address):
-        self.priority = priority
+    def __init__(self, packet_builder, type, seq_num, data):
+        self.packet_builder = packet_builder
         self.type = type
         self.seq_num = seq_num
         self.length = len(data)
         self.data = data
 
-        self.source_address = source_address
-        self.destination_address = destination_address
-
-        self.inner_header = struct.pack("!cII", type.encode('ascii'), socket.htonl(seq_num), self.length)
-        self.data = data.encode()
-        self.inner_packet = self.inner_header + self.data
-
-        self.outer_header = self.create_outer_header()
-        self.packet = self.outer_header + self.inner_packet
         self.sent_time = None
         self.attempts = 1
 
-    def convert_ip_to_int(self, ip_string):
-        return struct.unpack("!L", socket.inet_aton(ip_string))[0]
-
-    def create_outer_header(self):
-        int_src_ip = self.convert_ip_to_int(self.source_address[0])
-        int_dest_ip = self.convert_ip_to_int(self.destination_address[0])
-        src_port = self.source_address[1]
-        dest_port = self.destination_address[1]
-
-        return struct.pack("!BIHIHI", self.priority, int_src_ip, src_port, int_dest_ip, dest_port, 9 + self.length)
+    def build(self):
+        return self.packet_builder.build(self.type, self.seq_num, self.data)
 
     def print_packet_info(self):
-        pack_type = 'DATA' if self.type == 'D' else 'END'
+        pack_type = {'D': 'DATA', 'S': 'SKIP'}.get(self.type, 'END')
         print(pack_type, "Packet")
         print('send time:      ', datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3])
-        print('requester addr: ', self.destination_address[0] + ':' + str(self.destination_address[1]))
+        destination_address = self.packet_builder.destination_address
+        print('requester addr: ', destination_address[0] + ':' + str(destination_address[1]))
         print('sequence:       ', self.seq_num)
         print('length:         ', self.length)
-        print('payload:        ', self.data.decode()[:4])
+        print('payload:        ', bytes(self.data[:4]))
         print()
 
-        return int(time.time() * 1000)
 
+class IncomingPacket(wire.PacketView):
+    __slots__ = ()
 
-class IncomingPacket:
     def __init__(self, packet):
-        outer_header = packet[:17]
-        inner_header = packet[17:26]
-
-        self.priority, self.src_ip, self.src_port, self.dest_ip, self.dest_port, self.outer_length = struct.unpack("!BIHIHI", outer_header)
-        self.type, self.seq_num, self.length = struct.unpack("!cII", inner_header)
-
-        self.type = str(self.type, 'UTF-8')
-        self.seq_num = socket.ntohl(self.seq_num)
-
-        self.data = packet[26:]
-        self.data = self.data.decode() if len(self.data) > 0 else ''
-
-        self.requester_address = (self.convert_int_to_ip(self.src_ip), self.src_port)
+        super().__init__(packet)
 
         if args.d:
             self.print_debug_info()
 
-    def convert_int_to_ip(self, int_ip):
-        return socket.inet_ntoa(struct.pack('!L', int_ip))
+    @property
+    def requester_address(self):
+        return self.src_ip, self.src_port
 
     def print_debug_info(self):
         print('==============INCOMING PACKET===============')
@@ -83,49 +71,468 @@ class IncomingPacket:
         print('Type             ' + str(self.type))
         print('Sequence Number  ' + str(self.seq_num))
         print('Inner Packet Len ' + str(self.length))
-        print('Data:            ' + str(self.data[:4]))
+        print('Data:            ' + str(bytes(self.payload[:4])))
         print('Requester Addr   ' + str(self.requester_address[0]))
         print('Requester Port   ' + str(self.requester_address[1]))
         print('============================================')
         print('')
 
 
+# Token bucket pacer on the monotonic nanosecond clock. Up to burst packets can go out back to back, after
+# which packets are spaced by the rate interval. The pacer never waits itself: a session sends only while
+# get_delay() is 0 and otherwise reports the delay as its next deadline, so the wait is spent in the selector.
+class Pacer:
+    def __init__(self, rate, burst):
+        self.enabled = rate > 0
+        self.interval_ns = 1_000_000_000 / rate if self.enabled else 0
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic_ns()
+
+    def refill(self):
+        now = time.monotonic_ns()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) / self.interval_ns)
+        self.last_refill = now
+
+    def get_delay(self):
+        if not self.enabled:
+            return 0
+
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) * self.interval_ns / 1_000_000_000
+
+    def take(self):
+        # Only called right after get_delay() returned 0
+        if self.enabled:
+            self.tokens -= 1
+
+
+# Retransmission timeout. In fixed mode it stays at the -t value, otherwise it follows the Jacobson/Karels
+# estimate from RTT samples of packets that were only sent once (Karn's rule) and each retransmission of a
+# packet doubles its timeout.
+class RttEstimator:
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    MIN_RTO = 0.01
+    MAX_RTO = 60
+
+    def __init__(self, initial_timeout, adaptive):
+        self.rto = initial_timeout / 1000
+        self.adaptive = adaptive
+        self.srtt = None
+        self.rttvar = None
+
+    def add_sample(self, packet, now):
+        if not self.adaptive or packet.attempts > 1:
+            return
+
+        rtt = now - packet.sent_time
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.MIN_RTO), self.MAX_RTO)
+
+    def get_timeout(self, attempts):
+        if not self.adaptive:
+            return self.rto
+
+        return min(self.rto * 2 ** (attempts - 1), self.MAX_RTO)
+
+
+# Additive increase / multiplicative decrease congestion window, in packets. Grows by one packet per ACK
+# until the slow start threshold and by one packet per window after it, and halves at most once per window
+# of data on a retransmission timeout. When disabled the window never limits sending.
+class CongestionWindow:
+    def __init__(self, enabled, slow_start_threshold):
+        self.enabled = enabled
+        self.size = 1 if enabled else float('inf')
+        self.slow_start_threshold = slow_start_threshold
+        self.recovery_seq_num = 0
+
+    def on_ack(self):
+        if not self.enabled:
+            return
+
+        if self.size < self.slow_start_threshold:
+            self.size += 1
+        else:
+            self.size += 1 / self.size
+
+    def on_timeout(self, seq_num, next_seq_num):
+        if not self.enabled or seq_num < self.recovery_seq_num:
+            return
+
+        self.size = max(self.size / 2, 1)
+        self.slow_start_threshold = self.size
+        self.recovery_seq_num = next_seq_num
+
+
+# Selective repeat window: packets are acknowledged individually and the window slides forward as soon as
+# its base has been acknowledged, so new packets can be sent while later ones are still outstanding.
+class SlidingWindow:
+    def __init__(self, window_len, rtt_estimator, congestion_window):
+        self.window_len = window_len
+        self.rtt_estimator = rtt_estimator
+        self.congestion_window = congestion_window
+        self.base = 1
+        self.next_seq_num = 1
+        self.sent_packets = {}
+
+        # Retransmission deadlines: (deadline, seq_num, attempts). Entries for packets that have since been
+        # acknowledged or resent are stale and skipped when they reach the top of the heap.
+        self.deadlines = []
+
+    def can_send(self):
+        return self.next_seq_num < self.base + self.window_len and len(self.sent_packets) < self.congestion_window.size
+
+    def is_empty(self):
+        return len(self.sent_packets) == 0
+
+    def add_packet(self, packet):
+        self.sent_packets[packet.seq_num] = packet
+        self.next_seq_num += 1
+
+    def replace_packet(self, packet):
+        self.sent_packets[packet.seq_num] = packet
+
+    def acknowledge(self, seq_num):
+        packet = self.sent_packets.pop(seq_num, None)
+        if packet is None:
+            return None
+
+        while self.base < self.next_seq_num and self.base not in self.sent_packets:
+            self.base += 1
+
+        return packet
+
+    def start_timer(self, packet):
+        heapq.heappush(self.deadlines, (packet.sent_time + self.rtt_estimator.get_timeout(packet.attempts), packet.seq_num, packet.attempts))
+
+    def get_next_deadline(self):
+        while len(self.deadlines) > 0 and not self.is_current(self.deadlines[0]):
+            heapq.heappop(self.deadlines)
+
+        return self.deadlines[0][0] if len(self.deadlines) > 0 else None
+
+    def get_expired_packets(self, now):
+        expired_packets = []
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            deadline = heapq.heappop(self.deadlines)
+            if self.is_current(deadline):
+                expired_packets.append(self.sent_packets[deadline[1]])
+
+        return expired_packets
+
+    def is_current(self, deadline):
+        packet = self.sent_packets.get(deadline[1])
+        return packet is not None and packet.attempts == deadline[2]
+
+
 class SenderSocket:
-    def __init__(self, listening_port_num, emulator_address):
-        self.listen_address = (socket.gethostbyname(socket.gethostname()), listening_port_num)
+    def __init__(self, listening_port_num, emulator_address, host_name):
+        self.listen_address = (socket.gethostbyname(host_name), listening_port_num)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind(self.listen_address)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.batch_socket = batch_io.BatchSocket(self.socket)
+        self.incoming_buffers = []
 
         self.emulator_address = emulator_address
-        self.total_retransmissions = 0
-        self.total_transmissions = 0
 
-    def await_file_request(self):
-        full_packet, requester_address = self.socket.recvfrom(5500)
+    def await_packets(self):
+        self.incoming_buffers = []
+        incoming_packets = []
+        for buffer, length, requester_address in self.batch_socket.receive_batch():
+            self.incoming_buffers.append(buffer)
+            incoming_packets.append(IncomingPacket(memoryview(buffer)[:length]))
+
+        return incoming_packets
+
+    def release_packets(self):
+        for buffer in self.incoming_buffers:
+            self.batch_socket.release(buffer)
+        self.incoming_buffers = []
+
+    def send_packet(self, packet):
+        packet.sent_time = time.monotonic()
+        try:
+            self.socket.sendto(packet.build(), self.emulator_address)
+        except BlockingIOError:
+            # Treated like a loss on the network, the retransmission timer will resend it
+            pass
+
+    def wait_for_packets(self, timeout):
+        return len(self.selector.select(timeout)) > 0
+
+
+# Payloads sliced out of file data as they are sent, for byte ranges and files too large for the chunk cache
+class FileChunks:
+    def __init__(self, file_data, payload_len):
+        self.file_data = file_data
+        self.payload_len = payload_len
+
+    def __len__(self):
+        return -(-len(self.file_data) // self.payload_len)
+
+    def __getitem__(self, index):
+        start = index * self.payload_len
+        return self.file_data[start:start + self.payload_len]
+
+
+# Files already split into packet payloads, shared by every session that sends them. Entries are keyed by
+# file name, modification time and payload length, so an edited file is read again, and the least recently
+# used files are dropped once the cached payloads exceed max_bytes. Files larger than the whole cache are
+# memory mapped instead. A request for a byte range of a file is served from the same cached data.
+class ChunkCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # (filename, mtime, payload length) -> (chunks, file data), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_chunks(self, filename, payload_len, byte_range=None):
+        file_stat = os.stat(filename)
+        key = (filename, file_stat.st_mtime_ns, payload_len)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            entry = self.load_chunks(filename, file_stat.st_size, payload_len)
+            if entry[0] is not None:
+                self.entries[key] = entry
+                self.size += len(entry[1])
+                while self.size > self.max_bytes:
+                    self.size -= len(self.entries.popitem(last=False)[1][1])
+
+        chunks, file_data = entry
+        if byte_range is not None:
+            start, length = byte_range
+            return FileChunks(file_data[start:] if length is None else file_data[start:start + length], payload_len)
+        if chunks is None:
+            return FileChunks(file_data, payload_len)
+
+        return chunks
+
+    def load_chunks(self, filename, file_size, payload_len):
+        if file_size > self.max_bytes:
+            return None, map_file(filename)
+
+        with open(filename, 'rb') as file:
+            file_data = memoryview(file.read())
+
+        return [file_data[start:start + payload_len] for start in range(0, len(file_data), payload_len)], file_data
+
+    def print_stats(self):
+        print('----------Chunk Cache Stats----------')
+        print('hits:         ', self.hits)
+        print('misses:       ', self.misses)
+        print('cached files: ', len(self.entries))
+        print('cached bytes: ', self.size)
+        print()
+
 
-        return IncomingPacket(full_packet)
+# One file transfer to one requester. Every session has its own window, timers and pacing, so transfers to
+# different requesters proceed independently over the shared socket. A session sends one packet at a time when
+# its pacer allows it, timed out packets ahead of new data, and the event loop takes the sessions in turn.
+class Session:
+    def __init__(self, sender_socket, request_packet, filename, chunks, args):
+        self.requester_address = request_packet.requester_address
+        self.filename = filename
+        self.chunks = chunks
+        self.next_chunk = 0
+        self.retransmit_queue = deque()
+        self.max_attempts = args.a
+        self.verbose = args.v
+        self.rtt = program_metrics.get_histogram('rtt')
+
+        window_len = request_packet.length
+        self.rtt_estimator = RttEstimator(args.t, args.m != 'fixed')
+        self.window = SlidingWindow(window_len, self.rtt_estimator, CongestionWindow(args.m == 'aimd', window_len))
+        self.packet_builder = wire.PacketBuilder(args.i, sender_socket.listen_address, self.requester_address,
+                                                 args.l)
+        self.pacer = Pacer(0 if args.m == 'aimd' else args.r, args.b)
+
+        self.bytes_sent = 0
+        self.retransmissions = 0
+        self.transmissions = 0
+        self.start_time = time.time()
+        self.last_activity = time.monotonic()
+
+    def has_data(self):
+        return self.next_chunk < len(self.chunks)
+
+    def is_complete(self):
+        return not self.has_data() and self.window.is_empty()
+
+    def send_packet(self, sender_socket, packet, transmission_type='I'):
+        if transmission_type == 'R':
+            self.retransmissions += 1
+            program_metrics.increment('retransmissions')
+
+        self.transmissions += 1
+        program_metrics.increment('transmissions')
+        sender_socket.send_packet(packet)
+
+    def send_next_packet(self, sender_socket):
+        # Returns False when the session has nothing it may send right now
+        if self.pacer.get_delay() > 0:
+            return False
+
+        window = self.window
+        packet = None
+        while packet is None and len(self.retransmit_queue) > 0:
+            packet = self.retransmit_queue.popleft()
+            if window.sent_packets.get(packet.seq_num) is not packet:
+                # Acknowledged while it was waiting
+                packet = None
+
+        if packet is None:
+            if not self.has_data() or not window.can_send():
+                return False
+
+            packet = OutgoingPacket(self.packet_builder, 'D', window.next_seq_num, self.chunks[self.next_chunk])
+            window.add_packet(packet)
+            self.next_chunk += 1
+            self.bytes_sent += packet.length
+
+        if self.verbose and packet.attempts == 1:
+            packet.print_packet_info()
+        self.pacer.take()
+        self.send_packet(sender_socket, packet, 'R' if packet.attempts > 1 else 'I')
+        window.start_timer(packet)
+        return True
+
+    def get_next_deadline(self):
+        deadline = self.window.get_next_deadline()
+        if len(self.retransmit_queue) > 0 or (self.has_data() and self.window.can_send()):
+            send_time = time.monotonic() + self.pacer.get_delay()
+            deadline = send_time if deadline is None else min(deadline, send_time)
+
+        return deadline
+
+    def handle_packet(self, incoming_packet, now):
+        self.last_activity = now
+
+        if incoming_packet.type == 'A':
+            self.acknowledge_packet(incoming_packet.seq_num, now)
+        elif incoming_packet.type == 'C':
+            # Cumulative ACK for everything up to seq_num plus a bitmap of packets received past it
+            for seq_num in range(self.window.base, incoming_packet.seq_num + 1):
+                self.acknowledge_packet(seq_num, now)
+            for seq_num in wire.parse_sack_bitmap(incoming_packet.seq_num, incoming_packet.payload):
+                self.acknowledge_packet(seq_num, now)
+
+    def acknowledge_packet(self, seq_num, now):
+        outgoing_packet = self.window.acknowledge(seq_num)
+        if outgoing_packet is not None:
+            if outgoing_packet.attempts == 1:
+                self.rtt.record(now - outgoing_packet.sent_time)
+            self.rtt_estimator.add_sample(outgoing_packet, now)
+            self.window.congestion_window.on_ack()
+
+    def queue_expired_packets(self, now):
+        window = self.window
+        for outgoing_packet in window.get_expired_packets(now):
+            window.congestion_window.on_timeout(outgoing_packet.seq_num, window.next_seq_num)
+
+            if outgoing_packet.type == 'D' and outgoing_packet.attempts >= self.max_attempts:
+                print("ERROR: Attempted sending packet with sequence number " + str(outgoing_packet.seq_num)
+                      + " " + str(self.max_attempts) + " total times without acknowledgement. Packet dropped.")
+                print("")
+                program_metrics.increment('abandoned packets')
+                # The requester would otherwise wait for the dropped packet forever and refuse everything a
+                # window past it, so it is told to move on. The skip takes the packet's place in the window and,
+                # unlike data, is resent until it is acknowledged.
+                outgoing_packet = OutgoingPacket(self.packet_builder, 'S', outgoing_packet.seq_num, b'')
+                window.replace_packet(outgoing_packet)
+            else:
+                outgoing_packet.attempts += 1
+
+            self.retransmit_queue.append(outgoing_packet)
+
+    def finish(self, sender_socket):
+        packet = OutgoingPacket(self.packet_builder, 'E', self.window.next_seq_num, b'')
+        if self.verbose:
+            packet.print_packet_info()
+        self.send_packet(sender_socket, packet)
+        self.print_stats()
+
+    def print_stats(self):
+        duration = time.time() - self.start_time
+
+        print('Sent ' + self.filename + ' to ' + self.requester_address[0] + ':' + str(self.requester_address[1]))
+        print('Packet Loss Rate: ' + str((self.retransmissions / self.transmissions) * 100)
+              + '% on ' + str(self.retransmissions) + ' retransmissions and '
+              + str(self.transmissions) + ' total transmissions')
+        print('Goodput: ' + str(round(self.bytes_sent / duration)) + ' bytes/second over '
+              + str(round(duration * 1000)) + ' ms')
+        if self.rtt_estimator.srtt is not None:
+            print('Smoothed RTT: ' + str(round(self.rtt_estimator.srtt * 1000, 2)) + ' ms, final timeout: '
+                  + str(round(self.rtt_estimator.rto * 1000, 2)) + ' ms')
+        print()
+
+
+# Active sessions keyed by requester address. A session that has heard nothing from its requester for
+# idle_timeout seconds is evicted, and requests are refused while max_sessions transfers are running.
+class SessionTable:
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+
+    def get(self, requester_address):
+        return self.sessions.get(requester_address)
+
+    def get_sessions(self):
+        return list(self.sessions.values())
 
-    def await_ack(self):
-        full_packet, requester_address = self.socket.recvfrom(5500)
+    def is_full(self):
+        return len(self.sessions) >= self.max_sessions
 
-        return IncomingPacket(full_packet)
+    def add(self, session):
+        self.sessions[session.requester_address] = session
 
-    def send_packet(self, packet, transmission_type = 'I'):
-        if (transmission_type == 'R'):
-            self.total_retransmissions += 1
+    def remove(self, session):
+        del self.sessions[session.requester_address]
 
-        self.total_transmissions += 1
+    def evict_idle_sessions(self, now):
+        for session in self.get_sessions():
+            if now - session.last_activity >= self.idle_timeout:
+                print('Session sending ' + session.filename + ' to ' + session.requester_address[0] + ':'
+                      + str(session.requester_address[1]) + ' was idle for ' + str(self.idle_timeout)
+                      + ' seconds and has been evicted')
+                print()
+                program_metrics.increment('evicted sessions')
+                self.remove(session)
 
-        packet.sent_time = int(time.time() * 1000)
-        self.socket.sendto(packet.packet, self.emulator_address)
+    def get_next_deadline(self):
+        deadlines = [session.get_next_deadline() for session in self.sessions.values()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if len(self.sessions) > 0:
+            deadlines.append(min(session.last_activity for session in self.sessions.values()) + self.idle_timeout)
 
-    def settimeout(self, timeout):
-        self.socket.settimeout(timeout)
+        return min(deadlines) if len(deadlines) > 0 else None
 
 
 def get_args():
     parser = argparse.ArgumentParser(usage="sender.py -p <port> -g <requester port> -r <rate> -q <seq_no> -l <length> "
-                                           "-f <f_hostname> -e <f_port> -i <priority> -t <timeout>")
+                                           "-f <f_hostname> -e <f_port> -i <priority> -t <timeout> [-m <mode>] [-b <burst>] [-a <attempts>] "
+                                           "[-s <sessions>] [-w <idle_timeout>] [-c <cache_mb>] [-u <host_name>] "
+                                           "[-x <metrics_file>] [-v]")
 
     parser.add_argument('-p', choices=range(2050, 65536), type=int,
                         help='Port number the sender should wait for requests on', required=True)
@@ -138,91 +545,160 @@ def get_args():
     parser.add_argument('-e', choices=range(2050, 65536), type=int, help='the port of the emulator.', required=True)
     parser.add_argument('-i', choices=range(1, 4), type=int, help='Priority level to send packets at.', required=True)
     parser.add_argument('-t', type=int, help='Timeout for retransmission for lost packs in milliseconds', required=True)
+    parser.add_argument('-m', choices=['fixed', 'adaptive', 'aimd'], default='fixed',
+                        help='fixed: -t timeout and -r rate, adaptive: estimated timeout and -r rate, '
+                             'aimd: estimated timeout and a congestion window instead of -r', required=False)
+    parser.add_argument('-b', type=int, default=1, help='Packets that may be sent back to back before pacing at -r',
+                        required=False)
+    parser.add_argument('-a', type=int, default=6, help='Attempts before an unacknowledged packet is dropped',
+                        required=False)
+    parser.add_argument('-s', type=int, default=64, help='Transfers that may run at the same time', required=False)
+    parser.add_argument('-w', type=float, default=30,
+                        help='Seconds without a packet from a requester before its transfer is dropped', required=False)
+    parser.add_argument('-c', type=int, default=64, help='Megabytes of file chunks cached across requests',
+                        required=False)
+    parser.add_argument('-u', type=str, default=socket.gethostname(), help='Host name to listen on', required=False)
+    parser.add_argument('-x', type=str, help='File to write a metrics snapshot to every second', required=False)
+    parser.add_argument('-v', action='store_true', help='Print every packet sent', required=False)
     parser.add_argument('-d', type=bool, default=False, help='Debug mode', required=False)
     return parser.parse_args()
 
 
-def await_acks(sent_packets, sender_socket, timeout, packet_rate):
-    sender_socket.settimeout(0)
+def map_file(filename):
+    # Payloads are sliced straight out of the mapped file and copied once, into the outgoing packet buffer
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(b'')
 
-    while len(sent_packets) > 0:
-        try:
-            incoming_packet = sender_socket.await_ack()
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
 
-            if incoming_packet.type == 'A' and incoming_packet.seq_num in sent_packets:
-                del sent_packets[incoming_packet.seq_num]
-        except BlockingIOError as e:
-            pass
 
-        for key in list(sent_packets.keys()):
-            outgoing_packet = sent_packets[key]
-            if int(time.time() * 1000) - outgoing_packet.sent_time > timeout:
-                if outgoing_packet.attempts >= 6:
-                    print("ERROR: Attempted sending packet with sequence number " + str(outgoing_packet.seq_num)
-                          + " six total times without acknowledgement. Packet dropped.")
-                    print("")
-                    del sent_packets[key]
-                else:
-                    outgoing_packet.attempts += 1
-                    send_time = int(time.time() * 1000)
-                    sender_socket.send_packet(outgoing_packet, 'R')
+def parse_byte_range(byte_range):
+    if byte_range == '':
+        return None
 
-                    while int(time.time() * 1000) < send_time + packet_rate:
-                        pass
+    start, length = byte_range.split(':')
+    start = int(start)
+    length = None if length == '' else int(length)
+    if start < 0 or (length is not None and length < 0):
+        raise ValueError('negative byte range')
 
+    return start, length
 
-def send_file(sender_socket, request_packet, args):
-    filename = request_packet.data
-    window_len = request_packet.length
+
+def start_session(sender_socket, sessions, chunk_cache, request_packet, args):
+    requester_address = request_packet.requester_address
+    if sessions.get(requester_address) is not None:
+        # A repeated request for a transfer that is already running
+        return
+
+    # A request for part of a file follows the name with a NUL and '<offset>:<length>' in bytes, where an
+    # empty length runs to the end of the file
+    filename, _, byte_range = request_packet.data.partition('\0')
+    if sessions.is_full():
+        print('Request for ' + filename + ' from ' + requester_address[0] + ':' + str(requester_address[1])
+              + ' refused, ' + str(sessions.max_sessions) + ' transfers are already running')
+        print()
+        program_metrics.increment('refused requests')
+        return
 
     try:
-        file = open(filename, 'r')
+        byte_range = parse_byte_range(byte_range)
+    except ValueError:
+        print('Request for ' + filename + ' has an invalid byte range')
+        print()
+        return
+
+    try:
+        chunks = chunk_cache.get_chunks(filename, args.l, byte_range)
     except IOError:
         print(f"{filename} does not exist in this folder")
-        exit(-1)
+        print()
+        return
 
-    sent_packets = {}
-    packet_rate = 1000 / args.r
-    seq_num = 1
-    rem_file_size = os.path.getsize(filename)
+    sessions.add(Session(sender_socket, request_packet, filename, chunks, args))
+    program_metrics.increment('sessions')
 
-    while rem_file_size > 0:
-        for window in range(window_len):
-            if rem_file_size <= 0:
-                break
 
-            packet = OutgoingPacket(args.i, 'D', seq_num, file.read(args.l),
-                                    sender_socket.listen_address, request_packet.requester_address)
-            sent_packets[seq_num] = packet
+def receive_packets(sender_socket, sessions, chunk_cache, args):
+    while True:
+        incoming_packets = sender_socket.await_packets()
+        if len(incoming_packets) == 0:
+            return
 
-            send_time = packet.print_packet_info()
-            sender_socket.send_packet(packet)
+        now = time.monotonic()
+        for incoming_packet in incoming_packets:
+            try:
+                handle_incoming_packet(sender_socket, sessions, chunk_cache, incoming_packet, now, args)
+            except (struct.error, UnicodeDecodeError) as e:
+                # A stray datagram must not take down the transfers that are running
+                print('Dropped a malformed packet of ' + str(len(incoming_packet.buffer)) + ' bytes: ' + str(e))
+                print()
+                program_metrics.increment('malformed packets')
 
-            while int(time.time() * 1000) < send_time + packet_rate:
-                pass
+        sender_socket.release_packets()
 
-            seq_num += 1
-            rem_file_size -= packet.length
 
-        await_acks(sent_packets, sender_socket, args.t, packet_rate)
+def handle_incoming_packet(sender_socket, sessions, chunk_cache, incoming_packet, now, args):
+    if incoming_packet.type == 'R':
+        start_session(sender_socket, sessions, chunk_cache, incoming_packet, args)
+        return
 
-    packet = OutgoingPacket(args.i, 'E', seq_num, '', sender_socket.listen_address, request_packet.requester_address)
-    packet.print_packet_info()
-    sender_socket.send_packet(packet)
+    session = sessions.get(incoming_packet.requester_address)
+    if session is not None:
+        session.handle_packet(incoming_packet, now)
 
-    print('Packet Loss Rate: ' + str((sender_socket.total_retransmissions / sender_socket.total_transmissions) * 100)
-          + '% on ' + str(sender_socket.total_retransmissions) + ' retransmissions and '
-          + str(sender_socket.total_transmissions) + ' total transmissions')
 
+def send_packets(sender_socket, sessions):
+    # One packet per session per round, so every session gets its own -r however large its window is
+    sending = sessions.get_sessions()
+    while len(sending) > 0:
+        sending = [session for session in sending if session.send_next_packet(sender_socket)]
 
-if __name__ == '__main__':
-    args = get_args()
 
-    emulator_address = (socket.gethostbyname(args.f), args.e)
-    sender_socket = SenderSocket(args.p, emulator_address)
-    request_packet = sender_socket.await_file_request()
+def serve_requests(sender_socket, args):
+    sessions = SessionTable(args.s, args.w)
+    chunk_cache = ChunkCache(args.c * 1024 * 1024)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: chunk_cache.print_stats())
+
+    while True:
+        send_packets(sender_socket, sessions)
 
-    send_file(sender_socket, request_packet, args)
+        deadlines = [sessions.get_next_deadline(), program_metrics.get_next_snapshot_time()]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        timeout = max(0, min(deadlines) - time.monotonic()) if len(deadlines) > 0 else None
+        if timeout is not None:
+            # The selector sleeps whole milliseconds rounded up, which would stretch pacing gaps, so it sleeps the
+            # whole milliseconds and the rest is polled
+            timeout = math.floor(timeout / SELECT_RESOLUTION) * SELECT_RESOLUTION
 
+        if sender_socket.wait_for_packets(timeout):
+            receive_packets(sender_socket, sessions, chunk_cache, args)
 
+        now = time.monotonic()
+        for session in sessions.get_sessions():
+            session.queue_expired_packets(now)
+            if session.is_complete():
+                session.finish(sender_socket)
+                sessions.remove(session)
 
+        sessions.evict_idle_sessions(now)
+        program_metrics.write_due_snapshot(now)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    emulator_address = (socket.gethostbyname(args.f), args.e)
+    sender_socket = SenderSocket(args.p, emulator_address, args.u)
+    if args.x is not None:
+        program_metrics.start_snapshots(args.x)
+
+    # Stop through SystemExit so the final metrics snapshot gets written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve_requests(sender_socket, args)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        program_metrics.write_snapshot()
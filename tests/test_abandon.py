@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'sender'), os.path.join(REPO_DIR, 'requester')]
+import requester
+import sender
+import wire
+
+SENDER_ADDRESS = ('127.0.0.1', 5000)
+REQUESTER_ADDRESS = ('127.0.0.1', 4000)
+PAYLOAD_LEN = 10
+WINDOW = 4
+MAX_ATTEMPTS = 3
+
+
+# Stands in for the sender's socket and keeps every packet sent as bytes
+class RecordingSocket:
+    def __init__(self):
+        self.listen_address = SENDER_ADDRESS
+        self.sent = []
+
+    def send_packet(self, packet):
+        packet.sent_time = time.monotonic()
+        self.sent.append(bytes(packet.build()))
+
+
+def make_session(sender_socket, chunks):
+    args = argparse.Namespace(a=MAX_ATTEMPTS, v=False, t=100, m='fixed', i=1, l=PAYLOAD_LEN, r=0, b=1)
+    # A request carries the requester's window in its length field
+    request = argparse.Namespace(requester_address=REQUESTER_ADDRESS, length=WINDOW)
+    return sender.Session(sender_socket, request, 'file', chunks, args)
+
+
+class AbandonTest(unittest.TestCase):
+    def setUp(self):
+        self.output = tempfile.TemporaryFile()
+
+    def tearDown(self):
+        self.output.close()
+
+    def test_skip_moves_reorder_buffer_on(self):
+        reorder_buffer = requester.ReorderBuffer(self.output, 0, WINDOW)
+        self.assertTrue(reorder_buffer.add_data(1, b'a'))
+        self.assertFalse(reorder_buffer.add_data(2 + WINDOW, b'x'))
+
+        self.assertTrue(reorder_buffer.add_data(3, b'c'))
+        self.assertTrue(reorder_buffer.add_data(2, b''))
+        self.assertEqual(reorder_buffer.next_seq_num, 4)
+        self.assertTrue(reorder_buffer.add_data(2 + WINDOW, b'x'))
+
+    def test_transfer_continues_past_abandoned_packet(self):
+        # Every transmission of data packet 2 is lost, the rest of the path is perfect
+        chunks = [bytes([65 + index]) * PAYLOAD_LEN for index in range(20)]
+        sender_socket = RecordingSocket()
+        session = make_session(sender_socket, chunks)
+        reorder_buffer = requester.ReorderBuffer(self.output, 0, WINDOW)
+        ack_builder = wire.PacketBuilder(1, REQUESTER_ADDRESS, SENDER_ADDRESS)
+
+        for _ in range(100):
+            if session.is_complete():
+                break
+
+            while session.send_next_packet(sender_socket):
+                pass
+            sent, sender_socket.sent = sender_socket.sent, []
+            for buffer in sent:
+                packet = wire.PacketView(buffer)
+                if packet.type == 'D' and packet.seq_num == 2:
+                    continue
+
+                self.assertTrue(reorder_buffer.add_data(packet.seq_num, packet.payload))
+                session.handle_packet(wire.PacketView(ack_builder.build('A', packet.seq_num)), time.monotonic())
+
+            # Far enough ahead that every outstanding packet has timed out
+            session.queue_expired_packets(time.monotonic() + 60)
+
+        self.assertTrue(session.is_complete())
+        self.assertEqual(reorder_buffer.next_seq_num, len(chunks) + 1)
+        self.output.seek(0)
+        self.assertEqual(self.output.read(), b''.join(chunks[:1] + chunks[2:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'requester')]
+import requester
+
+
+class SplitPortionTest(unittest.TestCase):
+    def get_ranges(self, replica_count, portion_size):
+        replicas = [('127.0.0.1', 5000 + index) for index in range(replica_count)]
+        return [stripe.byte_range for stripe in requester.split_portion(1, replicas, portion_size)]
+
+    def test_stripes_cover_portion_without_empty_ones(self):
+        for replica_count in range(1, 6):
+            for portion_size in range(1, 40):
+                ranges = self.get_ranges(replica_count, portion_size)
+                if ranges == [None]:
+                    continue
+
+                lengths = [length for start, length in ranges]
+                self.assertTrue(all(length > 0 for length in lengths))
+                self.assertLessEqual(max(lengths) - min(lengths), 1)
+                self.assertEqual(sum(lengths), portion_size)
+                self.assertEqual([start for start, length in ranges],
+                                 [sum(lengths[:index]) for index in range(len(lengths))])
+
+    def test_small_portion_uses_fewer_replicas(self):
+        self.assertEqual(self.get_ranges(4, 5), [(0, 2), (2, 1), (3, 1), (4, 1)])
+        self.assertEqual(self.get_ranges(4, 3), [(0, 1), (1, 1), (2, 1)])
+        self.assertEqual(self.get_ranges(3, None), [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import socket
+import struct
+
+# Outer header: priority, source ip, source port, destination ip, destination port, inner packet length
+OUTER_HEADER = struct.Struct("!BIHIHI")
+# Inner header: packet type, sequence number, payload length (or window size for requests)
+INNER_HEADER = struct.Struct("!cII")
+
+# The outer header minus its trailing length field, which is the same for every packet of a transfer
+OUTER_HEADER_PREFIX = struct.Struct("!BIHIH")
+OUTER_LENGTH = struct.Struct("!I")
+OUTER_LENGTH_OFFSET = OUTER_HEADER_PREFIX.size
+
+INNER_HEADER_OFFSET = OUTER_HEADER.size
+HEADER_LEN = OUTER_HEADER.size + INNER_HEADER.size
+MAX_PACKET_LEN = 5500
+
+IP_ADDRESS = struct.Struct("!L")
+
+
+def convert_int_to_ip(int_ip):
+    return socket.inet_ntoa(IP_ADDRESS.pack(int_ip))
+
+
+def convert_ip_to_int(ip_string):
+    return IP_ADDRESS.unpack(socket.inet_aton(ip_string))[0]
+
+
+# Read-only view over a received datagram. Header fields are unpacked the first time one of them is read
+# and the payload stays a memoryview, so a packet can be forwarded without copying or decoding it.
+class PacketView:
+    __slots__ = ('buffer', '_outer_header', '_inner_header')
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self._outer_header = None
+        self._inner_header = None
+
+    def get_outer_header(self):
+        if self._outer_header is None:
+            self._outer_header = OUTER_HEADER.unpack_from(self.buffer)
+
+        return self._outer_header
+
+    def get_inner_header(self):
+        if self._inner_header is None:
+            type, seq_num, length = INNER_HEADER.unpack_from(self.buffer, INNER_HEADER_OFFSET)
+            self._inner_header = (type.decode('ascii'), socket.ntohl(seq_num), length)
+
+        return self._inner_header
+
+    @property
+    def priority(self):
+        return self.get_outer_header()[0]
+
+    @property
+    def int_src_ip(self):
+        return self.get_outer_header()[1]
+
+    @property
+    def src_port(self):
+        return self.get_outer_header()[2]
+
+    @property
+    def int_dest_ip(self):
+        return self.get_outer_header()[3]
+
+    @property
+    def dest_port(self):
+        return self.get_outer_header()[4]
+
+    @property
+    def outer_length(self):
+        return self.get_outer_header()[5]
+
+    @property
+    def src_ip(self):
+        return convert_int_to_ip(self.int_src_ip)
+
+    @property
+    def dest_ip(self):
+        return convert_int_to_ip(self.int_dest_ip)
+
+    @property
+    def type(self):
+        return self.get_inner_header()[0]
+
+    @property
+    def seq_num(self):
+        return self.get_inner_header()[1]
+
+    @property
+    def length(self):
+        return self.get_inner_header()[2]
+
+    @property
+    def payload(self):
+        return self.buffer[HEADER_LEN:]
+
+    @property
+    def data(self):
+        return str(self.payload, 'UTF-8')
+
+
+# Writes packets for one source/destination pair into a reusable buffer. The constant part of the outer
+# header is packed once, so each packet only costs the length and inner header writes plus a payload copy.
+# The returned memoryview is only valid until the next call to build().
+class PacketBuilder:
+    def __init__(self, priority, source_address, destination_address, max_payload_len=0):
+        self.source_address = source_address
+        self.destination_address = destination_address
+
+        self.buffer = bytearray(HEADER_LEN + max_payload_len)
+        OUTER_HEADER_PREFIX.pack_into(self.buffer, 0, priority, convert_ip_to_int(source_address[0]),
+                                      source_address[1], convert_ip_to_int(destination_address[0]),
+                                      destination_address[1])
+
+    def build(self, type, seq_num, payload=b'', length=None):
+        payload_len = len(payload)
+        end = HEADER_LEN + payload_len
+        if end > len(self.buffer):
+            self.buffer = self.buffer[:HEADER_LEN] + bytearray(payload_len)
+
+        OUTER_LENGTH.pack_into(self.buffer, OUTER_LENGTH_OFFSET, INNER_HEADER.size + payload_len)
+        INNER_HEADER.pack_into(self.buffer, INNER_HEADER_OFFSET, type.encode('ascii'), socket.htonl(seq_num),
+                               payload_len if length is None else length)
+        self.buffer[HEADER_LEN:end] = payload
+
+        return memoryview(self.buffer)[:end]
+
+
+# Selective acknowledgement bitmaps follow a cumulative ACK for cumulative_seq_num: bit i, counted from the most
+# significant bit of the first byte, is set when packet cumulative_seq_num + 1 + i has been received.
+def build_sack_bitmap(cumulative_seq_num, seq_nums):
+    if len(seq_nums) == 0:
+        return b''
+
+    bitmap = bytearray((max(seq_nums) - cumulative_seq_num - 1) // 8 + 1)
+    for seq_num in seq_nums:
+        index = seq_num - cumulative_seq_num - 1
+        bitmap[index >> 3] |= 0x80 >> (index & 7)
+
+    return bitmap
+
+
+def parse_sack_bitmap(cumulative_seq_num, bitmap):
+    for byte_index, byte in enumerate(bitmap):
+        if byte == 0:
+            continue
+
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                yield cumulative_seq_num + 1 + byte_index * 8 + bit